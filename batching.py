@@ -0,0 +1,81 @@
+"""
+Age limits for handlers that batch records.
+
+A batching handler writes its batch out when a record comes in and finds the
+batch old enough. When no further record comes, an AgeFlusher thread writes
+it instead. flush_at_exit() writes whatever is left when a worker exits.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+from multiprocessing import util
+
+
+def flush_at_exit(handler):
+    """
+    Flushes handler when the process exits, before exitpriority 10 finalizers
+    such as a multiprocessing queue's. Pool workers leave through os._exit and
+    skip logging's atexit hook. Only a weak reference to the handler is kept;
+    close() should cancel the returned Finalize.
+    """
+    return util.Finalize(handler, _flush_ref, args=(weakref.ref(handler),), exitpriority=20)
+
+
+def _flush_ref(ref):
+    handler = ref()
+    if handler is not None:
+        handler.flush()
+
+
+class AgeFlusher:
+    """
+    Writes out a handler's batch once its first record is max_age_s old.
+
+    The handler calls batch_started() when a record goes into an empty
+    batch, and may check expired() on every record; both with the handler
+    lock held. A daemon thread, started once per process, waits for the
+    deadline under the handler lock and then calls write(). pending()
+    returns the number of records in the batch. write() must empty the
+    batch even when it fails; the failure is reported through the handler's
+    handleError, with a record standing for the lost batch.
+    """
+
+    def __init__(self, handler, max_age_s, pending, write, name='log-batch-flusher'):
+        self.handler = handler
+        self.max_age_s = max_age_s
+        self.pending = pending
+        self.write = write
+        self.name = name
+        self.started = 0.0
+        self._cond = threading.Condition(handler.lock)
+        self._pid = None
+
+    def batch_started(self):
+        self.started = time.monotonic()
+        # The thread does not survive a fork, so start it per process.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+        self._cond.notify()
+
+    def expired(self):
+        return time.monotonic() - self.started >= self.max_age_s
+
+    def _run(self):
+        with self._cond:
+            while True:
+                count = self.pending()
+                if not count:
+                    self._cond.wait()
+                    continue
+                remaining = self.started + self.max_age_s - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                try:
+                    self.write()
+                except Exception:
+                    self.handler.handleError(logging.makeLogRecord(
+                        dict(msg='Writing a batch of %d records failed', args=(count,))))
@@ -0,0 +1,688 @@
+#!/usr/bin/env python3
+"""
+Parametrized logging benchmark.
+
+Runs every combination of transport, worker count, line size, start method
+and thread vs process mode, with warmup runs and repeats, and writes the
+results as JSON and CSV:
+
+    ./bench.py --transport unlocked mp_rlock simple_queue --workers 1 8 \\
+               --line-size 100 10000 --duration 5 --repeats 3
+
+A transport is a Transport subclass registered with @register; see the
+existing ones below for how to add a new handler.
+"""
+import argparse
+import csv
+import functools
+import json
+import logging
+import logging.handlers
+import multiprocessing as mp
+import os
+import shutil
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mp_handler
+import race_cookbook_1
+import race_cookbook_sockethandler
+import race_simple_queue
+from binlog import BinaryFileHandler
+from double_buffer import DoubleBufferedFileHandler, DoubleBufferedWriter, drain, write_all
+from latency import SharedLatencyHistogram
+from locks import InstrumentedLock, TicketLock
+import mmap_segments
+from rotating import SizeRotatingFileHandler
+
+SINK = 'bench_output.txt'
+
+TRANSPORTS = {}
+
+def current_milli_time():
+    return time.time_ns() // 1_000_000
+
+def register(cls):
+    TRANSPORTS[cls.name] = cls
+    return cls
+
+class Transport:
+    """
+    A way of getting log lines from producers into the sink file.
+
+    setup() runs in the benchmark process before the producers start and
+    returns the picklable state passed to make_handler() in every producer
+    process. finish() runs once the producers are done and waits for any
+    listener to drain.
+
+    latency is None or a SharedLatencyHistogram that whatever writes the
+    sink should record enqueue-to-write latencies in. If instrument_lock is
+    set, transports with a cross-process lock wrap it in an InstrumentedLock
+    and keep it in lock.
+    """
+
+    name = None
+    latency = None
+    instrument_lock = False
+    lock = None
+
+    def setup(self, ctx, path):
+        return None
+
+    @staticmethod
+    def make_handler(state, path):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+@register
+class Unlocked(Transport):
+    """
+    A plain StreamHandler per process, as in race_threads_original.py.
+    """
+
+    name = 'unlocked'
+
+    def setup(self, ctx, path):
+        return self.latency
+
+    @staticmethod
+    def make_handler(state, path):
+        return LatencyStreamHandler(open(path, 'a'), state)
+
+@register
+class MpRLock(Transport):
+    """
+    MultiProcessingStreamHandler serialized on a shared mp.RLock.
+    """
+
+    name = 'mp_rlock'
+    handler_kwargs = {}
+
+    def make_lock(self, ctx):
+        return ctx.RLock()
+
+    def setup(self, ctx, path):
+        lock = self.make_lock(ctx)
+        if self.instrument_lock:
+            lock = self.lock = InstrumentedLock(lock, ctx)
+        return lock, self.latency, self.handler_kwargs
+
+    @staticmethod
+    def make_handler(state, path):
+        lock, latency, kwargs = state
+        return mp_handler.MultiProcessingStreamHandler(lock, stream=open(path, 'a'),
+                                                       latency=latency, **kwargs)
+
+@register
+class MpRLockBatch(MpRLock):
+    name = 'mp_rlock_batch'
+    handler_kwargs = dict(batch_records=64, batch_bytes=1024 * 1024, batch_max_age_ms=50)
+
+@register
+class MpRLockAtomic(MpRLock):
+    name = 'mp_rlock_atomic'
+    handler_kwargs = dict(atomic_append=True)
+
+@register
+class MpRLockCombine(MpRLock):
+    name = 'mp_rlock_combine'
+    handler_kwargs = dict(combine=True)
+
+@register
+class MpRLockDedup(MpRLock):
+    name = 'mp_rlock_dedup'
+    handler_kwargs = dict(dedup=True)
+
+@register
+class MpTicket(MpRLock):
+    """
+    MultiProcessingStreamHandler serialized on a FIFO locks.TicketLock.
+    """
+
+    name = 'mp_ticket'
+
+    def make_lock(self, ctx):
+        return TicketLock(ctx)
+
+@register
+class MpRLockFlushBytes(MpRLock):
+    name = 'mp_rlock_flush_bytes'
+    handler_kwargs = dict(flush_policy='bytes')
+
+@register
+class MpRLockFlushInterval(MpRLock):
+    name = 'mp_rlock_flush_interval'
+    handler_kwargs = dict(flush_policy='interval')
+
+@register
+class MpRLockFlushError(MpRLock):
+    name = 'mp_rlock_flush_error'
+    handler_kwargs = dict(flush_policy='error')
+
+def raw_queue_reader(log_queue, path, latency):
+    """
+    queue_reader for a BytesQueue: messages are read into a reused buffer
+    and written from there to the file descriptor.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        while True:
+            line = log_queue.get_view()
+            if line == b'__DONE__':
+                break
+            if latency is not None:
+                created = race_simple_queue.STAMP.unpack_from(line)[0]
+                line = line[race_simple_queue.STAMP.size:]
+            write_all(fd, [line, b'\n'])
+            if latency is not None:
+                latency.record_since(created)
+    finally:
+        os.close(fd)
+
+def queue_reader(log_queue, path, latency, deferred=False, pipelined=False):
+    if isinstance(log_queue, race_simple_queue.BytesQueue) and not (deferred or pipelined):
+        return raw_queue_reader(log_queue, path, latency)
+    formatter = race_simple_queue.DeferredFormatter() if deferred else None
+    fd = DoubleBufferedWriter(path) if pipelined else open(path, 'ab')
+    try:
+        done = False
+        while not done:
+            lines = []
+            for line in drain(log_queue) if pipelined else [log_queue.get()]:
+                if line == '__DONE__' or line == b'__DONE__':
+                    done = True
+                    break
+                if formatter is not None:
+                    line, created = formatter.format(line)
+                    if line is None:
+                        continue
+                elif latency is not None:
+                    created = race_simple_queue.STAMP.unpack_from(line)[0]
+                    line = line[race_simple_queue.STAMP.size:]
+                if isinstance(line, str):
+                    line = line.encode()
+                lines.append(line + b'\n')
+                if latency is not None:
+                    latency.record_since(created)
+            fd.writelines(lines)
+    finally:
+        fd.close()
+
+@register
+class SimpleQueue(Transport):
+    """
+    MultiProcessingQueueHandler into an mp.SimpleQueue drained by one reader
+    process, as in race_simple_queue.py.
+    """
+
+    name = 'simple_queue'
+    deferred = False
+    pipelined = False
+    dedup = False
+
+    def make_queue(self, ctx):
+        return ctx.SimpleQueue()
+
+    def setup(self, ctx, path):
+        self.queue = self.make_queue(ctx)
+        self.reader = ctx.Process(target=queue_reader, args=(self.queue, path, self.latency, self.deferred,
+                                                                 self.pipelined))
+        self.reader.start()
+        return self.queue, self.latency is not None, self.deferred, self.dedup
+
+    @staticmethod
+    def make_handler(state, path):
+        log_queue, stamp, deferred, dedup = state
+        return race_simple_queue.MultiProcessingQueueHandler(log_queue, stamp=stamp, deferred=deferred, dedup=dedup)
+
+    def finish(self):
+        self.queue.put('__DONE__')
+        self.reader.join()
+
+@register
+class Ring(SimpleQueue):
+    """
+    MultiProcessingQueueHandler into a SharedMemoryRingBuffer.
+    """
+
+    name = 'ring'
+
+    def make_queue(self, ctx):
+        return race_simple_queue.SharedMemoryRingBuffer(16 * 1024 * 1024, ctx)
+
+    def finish(self):
+        SimpleQueue.finish(self)
+        self.queue.close()
+        self.queue.unlink()
+
+@register
+class SimpleQueueDeferred(SimpleQueue):
+    name = 'simple_queue_deferred'
+    deferred = True
+
+@register
+class RingDeferred(Ring):
+    name = 'ring_deferred'
+    deferred = True
+
+@register
+class SimpleQueueBytes(SimpleQueue):
+    """
+    MultiProcessingQueueHandler into a BytesQueue, with no pickling, as in
+    race_simple_queue.py --bytes.
+    """
+
+    name = 'simple_queue_bytes'
+
+    def make_queue(self, ctx):
+        return race_simple_queue.BytesQueue(ctx)
+
+@register
+class SimpleQueueDedup(SimpleQueue):
+    name = 'simple_queue_dedup'
+    dedup = True
+
+@register
+class SimpleQueuePipeline(SimpleQueue):
+    name = 'simple_queue_pipeline'
+    pipelined = True
+
+def file_listener_configurer(path, pipelined=False, rollover=None, max_bytes=0, backup_count=0, binary=False):
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+        h.close()
+    if binary:
+        h = BinaryFileHandler(path)
+    elif pipelined:
+        h = DoubleBufferedFileHandler(path)
+    elif rollover == 'stock':
+        h = logging.handlers.RotatingFileHandler(path, 'a', max_bytes, backup_count)
+    elif rollover is not None:
+        h = SizeRotatingFileHandler(path, 'a', max_bytes, backup_count, background=rollover == 'background')
+    else:
+        h = logging.FileHandler(path, 'a')
+    h.setFormatter(logging.Formatter('%(message)s'))
+    root.addHandler(h)
+
+@register
+class CookbookQueue(Transport):
+    """
+    QueueHandler into an mp.Queue drained by the listener_process of
+    race_cookbook_1.py.
+    """
+
+    name = 'cookbook_queue'
+    pipelined = False
+    rollover = None
+    max_bytes = 0
+    backup_count = 0
+    binary = False
+
+    def setup(self, ctx, path):
+        self.path = path
+        self.queue = ctx.Queue(-1)
+        configurer = functools.partial(file_listener_configurer, path, self.pipelined, self.rollover,
+                                       self.max_bytes, self.backup_count, self.binary)
+        self.listener = ctx.Process(target=race_cookbook_1.listener_process,
+                                    args=(self.queue, configurer, self.latency, self.pipelined))
+        self.listener.start()
+        return self.queue
+
+    @staticmethod
+    def make_handler(state, path):
+        return logging.handlers.QueueHandler(state)
+
+    def finish(self):
+        self.queue.put(None)
+        self.listener.join()
+
+@register
+class CookbookPipeline(CookbookQueue):
+    """
+    listener_process draining its queue in bulk into a
+    DoubleBufferedFileHandler, as in race_cookbook_1.py --pipeline.
+    """
+
+    name = 'cookbook_pipeline'
+    pipelined = True
+
+@register
+class CookbookBinary(CookbookQueue):
+    """
+    listener_process writing the binary format of binlog.py, with its time
+    index in the sink's .idx file.
+    """
+
+    name = 'cookbook_binary'
+    binary = True
+
+@register
+class CookbookRotating(CookbookQueue):
+    """
+    listener_process writing through RotatingFileHandler, rolling over every
+    64 MiB; finish() joins the backups and the current file into the sink.
+    """
+
+    name = 'cookbook_rotating'
+    rollover = 'stock'
+    max_bytes = 64 * 1024 * 1024
+    backup_count = 1000
+
+    def finish(self):
+        CookbookQueue.finish(self)
+        joined = self.path + '.joined'
+        with open(joined, 'wb') as out:
+            for i in range(self.backup_count, 0, -1):
+                backup = f'{self.path}.{i}'
+                if os.path.exists(backup):
+                    with open(backup, 'rb') as fd:
+                        shutil.copyfileobj(fd, out)
+                    os.remove(backup)
+            with open(self.path, 'rb') as fd:
+                shutil.copyfileobj(fd, out)
+        os.replace(joined, self.path)
+
+@register
+class CookbookSizeRotating(CookbookRotating):
+    """
+    As cookbook_rotating, with SizeRotatingFileHandler.
+    """
+
+    name = 'cookbook_size_rotating'
+    rollover = 'size'
+
+@register
+class CookbookBackgroundRotating(CookbookRotating):
+    """
+    As cookbook_rotating, with SizeRotatingFileHandler rotating in the
+    background.
+    """
+
+    name = 'cookbook_background_rotating'
+    rollover = 'background'
+
+@register
+class CookbookSharded(Transport):
+    """
+    ShardedQueueHandler over one mp.Queue and listener_process per shard, as
+    in race_cookbook_1.py --shards; finish() concatenates the shards into
+    the sink.
+    """
+
+    name = 'cookbook_sharded'
+    shards = 4
+
+    def setup(self, ctx, path):
+        self.path = path
+        self.queues = [ctx.Queue(-1) for _ in range(self.shards)]
+        self.listeners = []
+        for i, shard_queue in enumerate(self.queues):
+            configurer = functools.partial(file_listener_configurer, race_cookbook_1.shard_path(path, i))
+            self.listeners.append(ctx.Process(target=race_cookbook_1.listener_process,
+                                              args=(shard_queue, configurer, self.latency)))
+        for listener in self.listeners:
+            listener.start()
+        return self.queues
+
+    @staticmethod
+    def make_handler(state, path):
+        return race_cookbook_1.ShardedQueueHandler(state)
+
+    def finish(self):
+        for shard_queue in self.queues:
+            shard_queue.put(None)
+        for listener in self.listeners:
+            listener.join()
+        with open(self.path, 'ab') as out:
+            for i in range(self.shards):
+                shard = race_cookbook_1.shard_path(self.path, i)
+                with open(shard, 'rb') as fd:
+                    while chunk := fd.read(1024 * 1024):
+                        out.write(chunk)
+                os.remove(shard)
+
+@register
+class MmapSegments(Transport):
+    """
+    Every producer writes straight into the memory-mapped segments of an
+    mmap_segments.SegmentLog; finish() joins them into the sink.
+    """
+
+    name = 'mmap_segments'
+
+    def setup(self, ctx, path):
+        self.log = mmap_segments.SegmentLog(path, ctx=ctx)
+        return self.log, self.latency
+
+    @staticmethod
+    def make_handler(state, path):
+        return mmap_segments.SegmentHandler(*state)
+
+    def finish(self):
+        self.log.close()
+        mmap_segments.join_segments(self.log.base, self.log.base, remove=True)
+
+def socket_receiver(path, use_asyncio, latency, port, ready, stop):
+    file_listener_configurer(path)
+    if use_asyncio:
+        server = race_cookbook_sockethandler.AsyncLogRecordReceiver(port=0)
+        port.value = server.socket.getsockname()[1]
+    else:
+        server = race_cookbook_sockethandler.LogRecordSocketReceiver(port=0)
+        port.value = server.server_address[1]
+    server.latency = latency
+    ready.set()
+    server.serve_until_stopped(stop)
+
+@register
+class Socket(Transport):
+    """
+    SocketHandler into the receivers of race_cookbook_sockethandler.py,
+    running in their own process.
+    """
+
+    name = 'socket'
+    use_asyncio = False
+    batching = False
+
+    def setup(self, ctx, path):
+        port = ctx.Value('i', 0)
+        ready = ctx.Event()
+        self.stop = ctx.Event()
+        self.receiver = ctx.Process(target=socket_receiver,
+                                    args=(path, self.use_asyncio, self.latency, port, ready, self.stop))
+        self.receiver.start()
+        ready.wait()
+        return port.value, self.batching
+
+    @staticmethod
+    def make_handler(state, path):
+        port, batching = state
+        if batching:
+            return race_cookbook_sockethandler.BatchingSocketHandler('localhost', port)
+        return logging.handlers.SocketHandler('localhost', port)
+
+    def finish(self):
+        self.stop.set()
+        self.receiver.join()
+
+@register
+class SocketBatch(Socket):
+    name = 'socket_batch'
+    batching = True
+
+@register
+class SocketAsyncio(Socket):
+    name = 'socket_asyncio'
+    use_asyncio = True
+
+@register
+class SocketAsyncioBatch(Socket):
+    name = 'socket_asyncio_batch'
+    use_asyncio = True
+    batching = True
+
+class LatencyStreamHandler(logging.StreamHandler):
+    """
+    A StreamHandler that records enqueue-to-write latency, for the unlocked
+    baseline.
+    """
+
+    def __init__(self, stream, latency):
+        logging.StreamHandler.__init__(self, stream)
+        self.latency = latency
+
+    def emit(self, record):
+        logging.StreamHandler.emit(self, record)
+        if self.latency is not None:
+            self.latency.record_since(record.created)
+
+start_barrier = None
+
+def init_producer(transport_cls, state, path, barrier):
+    global start_barrier
+    start_barrier = barrier
+    handler = transport_cls.make_handler(state, path)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+        h.close()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+def run_producers(threads, duration_s, line_size):
+    """
+    Log lines from threads threads for duration_s seconds and return the
+    line count of every thread.
+    """
+    line = '*' * line_size
+    counts = [0] * threads
+
+    def produce(i):
+        start_barrier.wait()
+        deadline = time.monotonic() + duration_s
+        total_lines = 0
+        while time.monotonic() < deadline:
+            for x in range(100):
+                logging.log(logging.INFO, line)
+            total_lines += 100
+        counts[i] = total_lines
+
+    workers = [threading.Thread(target=produce, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    for h in logging.getLogger().handlers:
+        h.flush()
+    return counts
+
+def run_once(transport_name, mode, workers, line_size, start_method, duration_s,
+             measure_latency=False, instrument_lock=False):
+    ctx = mp.get_context(start_method)
+    if os.path.exists(SINK):
+        os.remove(SINK)
+    open(SINK, 'w').close()
+    transport = TRANSPORTS[transport_name]()
+    if measure_latency:
+        transport.latency = SharedLatencyHistogram(ctx)
+    transport.instrument_lock = instrument_lock
+    state = transport.setup(ctx, SINK)
+    processes, threads = (1, workers) if mode == 'thread' else (workers, 1)
+    barrier = ctx.Barrier(processes * threads)
+    start_millis = current_milli_time()
+    with ProcessPoolExecutor(processes,
+                             mp_context=ctx,
+                             initializer=init_producer,
+                             initargs=(type(transport), state, SINK, barrier)) as pool:
+        futures = [pool.submit(run_producers, threads, duration_s, line_size) for _ in range(processes)]
+        producer_lines = [n for fut in futures for n in fut.result()]
+    transport.finish()
+    end_to_end_ms = current_milli_time() - start_millis
+    total_lines = sum(producer_lines)
+    result = dict(transport=transport_name, mode=mode, workers=workers, line_size=line_size,
+                start_method=start_method, duration_ms=duration_s * 1000,
+                lines=total_lines,
+                lines_per_ms=total_lines / (duration_s * 1000),
+                end_to_end_ms=end_to_end_ms,
+                end_to_end_lines_per_ms=total_lines / end_to_end_ms,
+                bytes_written=os.path.getsize(SINK),
+                producer_lines=producer_lines,
+                producer_cv=statistics.pstdev(producer_lines) / statistics.mean(producer_lines))
+    if transport.latency is not None:
+        result.update(('latency_' + k, v) for k, v in transport.latency.snapshot().summary().items())
+    if transport.lock is not None:
+        stats = transport.lock.snapshot()
+        result.update(lock_acquisitions=sum(s['acquisitions'] for s in stats),
+                      lock_wait_ms=sum(s['wait_ms'] for s in stats),
+                      lock_hold_ms=sum(s['hold_ms'] for s in stats),
+                      lock_max_wait_us=max(s['max_wait_us'] for s in stats),
+                      lock_stats=stats)
+    return result
+
+CSV_FIELDS = ['transport', 'mode', 'workers', 'line_size', 'start_method', 'repeat',
+              'duration_ms', 'lines', 'lines_per_ms', 'end_to_end_ms', 'end_to_end_lines_per_ms',
+              'bytes_written', 'producer_cv',
+              'latency_count', 'latency_p50_us', 'latency_p99_us', 'latency_p999_us', 'latency_max_us',
+              'lock_acquisitions', 'lock_wait_ms', 'lock_hold_ms', 'lock_max_wait_us']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--transport', nargs='+', default=['unlocked', 'mp_rlock'], choices=sorted(TRANSPORTS))
+    parser.add_argument('--workers', nargs='+', type=int, default=[8])
+    parser.add_argument('--line-size', nargs='+', type=int, default=[10_000])
+    parser.add_argument('--start-method', nargs='+', default=['forkserver'], choices=mp.get_all_start_methods())
+    parser.add_argument('--mode', nargs='+', default=['process'], choices=['thread', 'process'])
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--warmup', type=int, default=1, help='unrecorded runs before the repeats')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--latency', action='store_true', help='record enqueue-to-write latency histograms')
+    parser.add_argument('--lockstats', action='store_true', help='record cross-process lock wait and hold times')
+    parser.add_argument('--output', default='results', help='writes <output>.json and <output>.csv')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    results = []
+    for transport_name in args.transport:
+        for mode in args.mode:
+            for workers in args.workers:
+                for line_size in args.line_size:
+                    for start_method in args.start_method:
+                        for run in range(args.warmup + args.repeats):
+                            result = run_once(transport_name, mode, workers, line_size, start_method,
+                                              args.duration, args.latency, args.lockstats)
+                            if run < args.warmup:
+                                continue
+                            result['repeat'] = run - args.warmup
+                            results.append(result)
+                            print(f'{transport_name} {mode} workers={workers} line_size={line_size} '
+                                  f'{start_method} #{result["repeat"]}: lines: {result["lines"]:_}, '
+                                  f'lines/ms: {result["lines_per_ms"]:.2f}, '
+                                  f'end-to-end lines/ms: {result["end_to_end_lines_per_ms"]:.2f}, '
+                                  f'producer cv: {result["producer_cv"]:.3f}', flush=True)
+                            if args.latency:
+                                print(f'  latency p50 us: {result["latency_p50_us"]:_.1f}, '
+                                      f'p99 us: {result["latency_p99_us"]:_.1f}, '
+                                      f'p999 us: {result["latency_p999_us"]:_.1f}, '
+                                      f'max us: {result["latency_max_us"]:_.1f}', flush=True)
+                            if 'lock_acquisitions' in result:
+                                print(f'  lock acquisitions: {result["lock_acquisitions"]:_}, '
+                                      f'wait ms: {result["lock_wait_ms"]:_.1f}, '
+                                      f'hold ms: {result["lock_hold_ms"]:_.1f}, '
+                                      f'max wait us: {result["lock_max_wait_us"]:_.1f}', flush=True)
+    with open(args.output + '.json', 'w') as fd:
+        json.dump(results, fd, indent=2)
+    with open(args.output + '.csv', 'w', newline='') as fd:
+        writer = csv.DictWriter(fd, CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+if __name__ == '__main__':
+    main()
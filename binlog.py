@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+A compact binary log format with a sparse time index.
+
+A log file starts with MAGIC, followed by entries: a HEADER (kind, payload
+length, creation time, level, process id, logger name id) and the payload.
+A RECORD entry carries the formatted message. A NAME entry defines a logger
+name id and carries the name. Everything is little endian.
+
+Next to the log, path.idx holds INDEX entries. Every block of about
+index_every bytes of log gets a BLOCK entry with its start and end offset
+and the lowest and highest creation time in it. Records from many producers
+reach a listener a little out of order, so blocks may overlap in time.
+Every NAME entry gets an index entry pointing at it, so a reader that seeks
+into the middle of the log still knows all logger names.
+
+Run as a script, this is the reader tool:
+
+    ./binlog.py output.bin --since '2026-10-18 01:30' --until 1760751060 --level WARNING --pid 1234
+
+It reads only the blocks that overlap the time range, plus anything written
+after the last indexed block, and prints the matching records.
+"""
+import argparse
+import datetime
+import logging
+import math
+import os
+import struct
+import sys
+
+MAGIC = b'PYLOGBIN1\n'
+HEADER = struct.Struct('<BIdHII')
+RECORD = 1
+NAME = 2
+
+# Index entries: kind (BLOCK or NAME), start and end offset, lowest and
+# highest creation time.
+INDEX = struct.Struct('<BQQdd')
+BLOCK = 1
+
+# Bytes of log read at a time when decoding.
+CHUNK = 1024 * 1024
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+class BinaryFileHandler(logging.Handler):
+    """
+    A handler writing records to path in the binary format, and the sparse
+    index to path.idx. Both files are truncated on open.
+
+    The level, process id, creation time and logger name are stored as
+    fields; the payload is what the formatter makes of the record, the
+    message alone by default.
+    """
+
+    def __init__(self, path, index_every=64 * 1024):
+        logging.Handler.__init__(self)
+        self.baseFilename = os.path.abspath(path)
+        self.index_every = index_every
+        self._log = open(path, 'wb')
+        self._index = open(index_path(path), 'wb')
+        self._log.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._names = {}
+        self._start_block()
+
+    def _start_block(self):
+        self._block_start = self._offset
+        self._block_min = math.inf
+        self._block_max = -math.inf
+
+    def _end_block(self):
+        if self._offset > self._block_start:
+            self._index.write(INDEX.pack(BLOCK, self._block_start, self._offset,
+                                         self._block_min, self._block_max))
+            self._index.flush()
+        self._start_block()
+
+    def _write(self, header, payload):
+        self._log.write(header)
+        self._log.write(payload)
+        self._offset += len(header) + len(payload)
+
+    def _name_id(self, name):
+        name_id = self._names.get(name)
+        if name_id is None:
+            name_id = self._names[name] = len(self._names)
+            data = name.encode()
+            end = self._offset + HEADER.size + len(data)
+            self._index.write(INDEX.pack(NAME, self._offset, end, 0.0, 0.0))
+            self._write(HEADER.pack(NAME, len(data), 0.0, 0, 0, name_id), data)
+        return name_id
+
+    def emit(self, record):
+        try:
+            data = self.format(record).encode()
+            name_id = self._name_id(record.name)
+            self._write(HEADER.pack(RECORD, len(data), record.created, record.levelno,
+                                    record.process or 0, name_id), data)
+            self._block_min = min(self._block_min, record.created)
+            self._block_max = max(self._block_max, record.created)
+            if self._offset - self._block_start >= self.index_every:
+                self._end_block()
+            self.flush()
+        except RecursionError:  # See issue 36272
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            if self._log is not None:
+                self._log.flush()
+
+    def close(self):
+        with self.lock:
+            try:
+                if self._log is not None:
+                    self._end_block()
+                    self._log.close()
+                    self._index.close()
+                    self._log = self._index = None
+            finally:
+                logging.Handler.close(self)
+
+
+class BinaryLogReader:
+    """
+    Reads records back from a binary log. bytes_read counts the bytes of
+    log and index read so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.bytes_read = 0
+        self.blocks = []
+        self.names = {}
+        self._fd = open(path, 'rb')
+        if self._fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a binary log')
+        self.bytes_read += len(MAGIC)
+        self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(index_path(self.path), 'rb') as fd:
+                data = fd.read()
+        except FileNotFoundError:
+            data = b''
+        self.bytes_read += len(data)
+        # A torn last entry is ignored.
+        for kind, start, end, low, high in INDEX.iter_unpack(data[:len(data) - len(data) % INDEX.size]):
+            if kind == BLOCK:
+                self.blocks.append((start, end, low, high))
+            elif kind == NAME:
+                for _, _, _, _, _, name_id, payload in self._entries(start, end):
+                    self.names[name_id] = payload.decode()
+
+    def _entries(self, start, end=None):
+        """
+        Decode the entries from offset start to end, or to the end of the
+        log, as (offset, kind, created, level, pid, name id, payload). A
+        torn entry at the end is dropped.
+        """
+        self._fd.seek(start)
+        pending = b''
+        offset = start
+        while end is None or offset < end:
+            size = CHUNK if end is None else min(CHUNK, end - offset - len(pending))
+            chunk = self._fd.read(size) if size > 0 else b''
+            self.bytes_read += len(chunk)
+            data = pending + chunk if pending else chunk
+            pos = 0
+            while len(data) - pos >= HEADER.size:
+                kind, length, created, level, pid, name_id = HEADER.unpack_from(data, pos)
+                if len(data) - pos - HEADER.size < length:
+                    break
+                payload = data[pos + HEADER.size:pos + HEADER.size + length]
+                yield offset + pos, kind, created, level, pid, name_id, payload
+                pos += HEADER.size + length
+            offset += pos
+            pending = data[pos:]
+            if not chunk:
+                return
+
+    def records(self, since=None, until=None, min_level=0, pids=None):
+        """
+        Yield (created, level, pid, logger name, message) for the records
+        created in [since, until] with at least min_level and, if pids is
+        given, from one of those processes, in log order.
+        """
+        since = -math.inf if since is None else since
+        until = math.inf if until is None else until
+        ranges = [(start, end) for start, end, low, high in self.blocks if high >= since and low <= until]
+        indexed_end = max((end for _, end, _, _ in self.blocks), default=len(MAGIC))
+        ranges.append((indexed_end, None))
+        for start, end in ranges:
+            for _, kind, created, level, pid, name_id, payload in self._entries(start, end):
+                if kind == NAME:
+                    self.names[name_id] = payload.decode()
+                elif (kind == RECORD and since <= created <= until and level >= min_level
+                      and (pids is None or pid in pids)):
+                    yield created, level, pid, self.names.get(name_id, str(name_id)), payload.decode()
+
+    def close(self):
+        self._fd.close()
+
+
+def parse_time(text):
+    """
+    Seconds since the epoch, or an ISO 8601 date and time in local time.
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def parse_level(text):
+    return int(text) if text.isdigit() else logging.getLevelName(text.upper())
+
+
+def run_main():
+    parser = argparse.ArgumentParser(description='Print the records of a binary log in a time range.')
+    parser.add_argument('path', nargs='?', default='output.bin')
+    parser.add_argument('--since', type=parse_time, help='epoch seconds or ISO date and time')
+    parser.add_argument('--until', type=parse_time, help='epoch seconds or ISO date and time')
+    parser.add_argument('--level', type=parse_level, default=0, help='lowest level, a name or a number')
+    parser.add_argument('--pid', type=int, nargs='+', help='only records from these processes')
+    parser.add_argument('--count', action='store_true', help='print only the number of matching records')
+    args = parser.parse_args()
+    reader = BinaryLogReader(args.path)
+    matches = 0
+    try:
+        for created, level, pid, name, message in reader.records(args.since, args.until, args.level,
+                                                                 args.pid and set(args.pid)):
+            matches += 1
+            if not args.count:
+                when = datetime.datetime.fromtimestamp(created).isoformat(sep=' ', timespec='microseconds')
+                print(f'{when} {logging.getLevelName(level)} {pid} {name}: {message}')
+    except BrokenPipeError:
+        return
+    finally:
+        reader.close()
+    print(f'{matches:_} records, read {reader.bytes_read:_} of {os.path.getsize(args.path):_} bytes',
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run_main()
@@ -3,9 +3,12 @@ import sys
 import multiprocessing as mp
 from concurrent.futures import ProcessPoolExecutor
 import logging
+import os
 import time
 
-big_line = '*' * 10_000
+from framing import FRAME_MAGIC, FrameReassembler
+
+big_line = '*' * int(os.environ.get('LINE_LENGTH', 10_000))
 
 def current_milli_time():
     return time.time_ns() // 1_000_000
@@ -36,32 +39,70 @@ def run_producer():
     except BrokenPipeError:
         pass
 
+def check_lines(data):
+    """
+    Check a block of complete, newline-terminated lines.
+
+    Returns (ok, garbled, unexpected) where ok counts lines of exactly
+    len(big_line) stars, garbled counts star lines of any other length and
+    unexpected is the first line holding anything but stars, or None.
+    """
+    line_count = data.count(b'\n')
+    stride = len(big_line) + 1
+    if (len(data) == line_count * stride
+            and data[len(big_line)::stride].count(b'\n') == line_count
+            and not data.translate(None, b'*\n')):
+        return line_count, 0, None
+    ok = garbled = 0
+    for line in data.split(b'\n')[:line_count]:
+        line = line.strip()
+        if line.translate(None, b'*'):
+            return ok, garbled, line
+        if len(line) == len(big_line):
+            ok += 1
+        else:
+            garbled += 1
+    return ok, garbled, None
+
 def run_consumer():
     bad_line_count = 0
     ok_line_count = 0
     total_lines = 0
-    start_time = current_milli_time()
+    total_bytes = 0
+    start_time = time.perf_counter()
+    reassembler = None
     try:
         print(f'Line length is {len(big_line):_}', flush=True)
-        for line in sys.stdin:
-            line = line.strip()
-            total_lines += 1
-            all_stars = '*' * len(line)
-            if line == all_stars:
-                if len(line) == len(big_line):
-                    ok_line_count += 1
-                else:
-                    bad_line_count += 1
-            else:
-                print(f'Got unexpected line: {line}', flush=True)
+        stdin = sys.stdin.buffer
+        pending = b''
+        if stdin.peek(1)[:1] == bytes([FRAME_MAGIC]):
+            print('Reading framed records', flush=True)
+            reassembler = FrameReassembler()
+        while True:
+            chunk = stdin.read1(1024 * 1024)
+            if not chunk:
+                # A last line without a trailing newline is still a line.
+                chunk = b'\n' if pending else b''
+                if not chunk:
+                    break
+            total_bytes += len(chunk)
+            if reassembler is not None:
+                chunk = reassembler.feed(chunk)
+            data = pending + chunk if pending else chunk
+            cut = data.rfind(b'\n') + 1
+            pending = data[cut:]
+            ok, garbled, unexpected = check_lines(data[:cut] if cut < len(data) else data)
+            ok_line_count += ok
+            bad_line_count += garbled
+            if unexpected is not None:
+                print(f'Got unexpected line: {unexpected.decode(errors="replace")}', flush=True)
                 sys.exit(1)
-            if total_lines % 10_000 == 0:
-                spent_ms = current_milli_time() - start_time
-                spent_ms = spent_ms // 1000
-                if spent_ms == 0:
-                    spent_ms = 1
-                lines_per_ms = total_lines // spent_ms
-                msg = f'OK line count: {ok_line_count:_}, garbled line count: {bad_line_count:_}, lines/s: {lines_per_ms:_}'
+            last_report = total_lines // 10_000
+            total_lines += ok + garbled
+            if total_lines // 10_000 != last_report:
+                spent_s = time.perf_counter() - start_time
+                msg = (f'OK line count: {ok_line_count:_}, garbled line count: {bad_line_count:_}, '
+                       f'lines/s: {total_lines / spent_s:_.1f}, MB/s: {total_bytes / spent_s / 1_000_000:_.1f}')
                 print(msg, flush=True)
         print('Stdin closed', flush=True)
     except BrokenPipeError:
@@ -73,6 +114,9 @@ def run_consumer():
             print('Consumer exiting', flush=True)
             print(f'OK line count: {ok_line_count:_}', flush=True)
             print(f'Bad line count: {bad_line_count:_}', flush=True)
+            if reassembler is not None:
+                print(f'Frame sequence gaps: {reassembler.gaps:_}, '
+                      f'incomplete records: {reassembler.incomplete():_}', flush=True)
         except BrokenPipeError:
             pass
 
@@ -0,0 +1,51 @@
+"""
+Optional payload compression for the socket and queue transports.
+
+Only stdlib codecs are used. A payload is tagged with the id of the codec
+that produced it, so receivers can tell compressed and plain payloads apart.
+"""
+import lzma
+import zlib
+
+NONE = 0
+ZLIB = 1
+LZMA = 2
+
+CODECS = {'none': NONE, 'zlib': ZLIB, 'lzma': LZMA}
+
+# Payloads smaller than this are sent as they are.
+MIN_SIZE = 4096
+
+
+def compress(codec, data, min_size=MIN_SIZE):
+    """
+    Return (codec id, payload) for data. Payloads under min_size bytes are
+    not compressed and come back with codec id NONE.
+    """
+    if codec == NONE or len(data) < min_size:
+        return NONE, data
+    if codec == ZLIB:
+        return ZLIB, zlib.compress(data, 1)
+    if codec == LZMA:
+        return LZMA, lzma.compress(data, preset=0)
+    raise ValueError(f'Unknown codec id: {codec}')
+
+
+def decompress(codec, payload):
+    if codec == NONE:
+        return payload
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    if codec == LZMA:
+        return lzma.decompress(payload)
+    raise ValueError(f'Unknown codec id: {codec}')
+
+
+def codec_from_argv(argv):
+    """
+    The codec id selected by a --compress=<name> argument, NONE if absent.
+    """
+    for arg in argv:
+        if arg.startswith('--compress='):
+            return CODECS[arg.split('=', 1)[1]]
+    return NONE
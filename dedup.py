@@ -0,0 +1,173 @@
+"""
+Suppression of consecutive duplicate records for the multiprocess handlers.
+
+A run is a series of records of one logger, in one process, with the same
+level and message. The first record of a run is emitted as usual; the
+repeats are only counted. The count goes out as a summary record, "Last
+message repeated N times", on the same logger and level, when:
+
+- the logger logs something else, before that record;
+- the run has been counting for max_delay_s, by the next repeat or by a
+  timer thread when no repeat comes;
+- the handler is flushed or closed, or the worker process exits.
+
+So a flood of identical records costs one line per max_delay_s, and every
+repeat is still accounted for.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+
+SUMMARY = 'Last message repeated %d times'
+
+
+class DuplicateSuppressor:
+    """
+    The dedup stage of a handler. offer() takes a record that passed the
+    handler's filters and passes the records to emit for it, a pending
+    summary and the record itself or nothing, to handler._dispatch(). Every
+    record is dispatched while holding the handler lock, an RLock, so
+    a summary always goes out ahead of any record offered after it. The
+    timer thread dispatches under the same lock; a lock of its own would
+    deadlock against a flush() under the handler lock, as in
+    logging.shutdown().
+    """
+
+    def __init__(self, handler, max_delay_s=1.0):
+        self.handler = handler
+        self.max_delay_s = max_delay_s
+        # Logger name -> [message key, repeats, time of first unreported repeat, last repeat]
+        self._runs = {}
+        self._cond = threading.Condition(handler.lock)
+        self._timer_pid = None
+        _suppressors.add(self)
+
+    def offer(self, record):
+        if record.exc_info or record.stack_info or getattr(record, 'repeated', None) is not None:
+            key = None
+        else:
+            key = (record.levelno, record.getMessage())
+        with self._cond:
+            run = self._runs.get(record.name)
+            if run is not None and key is not None and run[0] == key:
+                if not run[1]:
+                    run[2] = record.created
+                    self._start_timer()
+                    self._cond.notify()
+                run[1] += 1
+                run[3] = record
+                if record.created - run[2] >= self.max_delay_s:
+                    self.handler._dispatch(self._summary(run))
+                return
+            if run is not None and run[1]:
+                self.handler._dispatch(self._summary(run))
+            self._runs[record.name] = [key, 0, 0.0, None]
+            self.handler._dispatch(record)
+
+    def _summary(self, run):
+        """
+        The summary record of a run, which then starts counting again.
+
+        Must be called with self._cond held.
+        """
+        last = run[3]
+        attrs = dict(last.__dict__, msg=SUMMARY, args=(run[1],), exc_info=None, exc_text=None,
+                     stack_info=None, repeated=run[1])
+        attrs.pop('message', None)
+        run[1] = 0
+        run[3] = None
+        return logging.makeLogRecord(attrs)
+
+    def drain(self):
+        """
+        Dispatch the summaries of all runs with unreported repeats.
+        """
+        with self._cond:
+            for run in self._runs.values():
+                if run[1]:
+                    self.handler._dispatch(self._summary(run))
+
+    def _start_timer(self):
+        # The timer thread does not survive a fork, so restart it per process.
+        if self._timer_pid == os.getpid():
+            return
+        self._timer_pid = os.getpid()
+        threading.Thread(target=self._run_timer, name='log-dedup-timer', daemon=True).start()
+
+    def _run_timer(self):
+        while True:
+            with self._cond:
+                pending = [run[2] for run in self._runs.values() if run[1]]
+                if not pending:
+                    self._cond.wait()
+                    continue
+                remaining = min(pending) + self.max_delay_s - time.time()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                now = time.time()
+                for run in self._runs.values():
+                    if run[1] and now - run[2] >= self.max_delay_s:
+                        summary = self._summary(run)
+                        try:
+                            self.handler._dispatch(summary)
+                        except Exception:
+                            self.handler.handleError(summary)
+
+    def _reset(self):
+        self._runs = {}
+        self._cond = threading.Condition(self.handler.lock)
+
+
+class DedupMixin:
+    """
+    The dedup stage for a logging.Handler subclass, which lists it first
+    among its bases. init_dedup() turns it on. handle() then passes the
+    records that get through the filters to a DuplicateSuppressor, and
+    flush() must call drain_dedup() before writing anything out. Records go
+    to the handler through _dispatch(), which emits under the handler lock
+    and may be overridden.
+    """
+
+    dedup = None
+
+    def init_dedup(self, max_delay_s):
+        self.dedup = DuplicateSuppressor(self, max_delay_s)
+
+    def handle(self, record):
+        """
+        Conditionally emit the specified logging record, through the dedup
+        stage if it is on.
+        """
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord):
+            record = rv
+        if rv:
+            if self.dedup is None:
+                self._dispatch(record)
+            else:
+                self.dedup.offer(record)
+        return rv
+
+    def _dispatch(self, record):
+        with self.lock:
+            self.emit(record)
+
+    def drain_dedup(self):
+        """
+        Emits any pending repeat summaries.
+        """
+        if self.dedup is not None:
+            self.dedup.drain()
+
+
+_suppressors = weakref.WeakSet()
+
+def _drop_runs_after_fork():
+    # The parent reports the repeats it counted before the fork.
+    for suppressor in _suppressors:
+        suppressor._reset()
+
+os.register_at_fork(after_in_child=_drop_runs_after_fork)
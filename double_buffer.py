@@ -0,0 +1,185 @@
+"""
+A receive/write pipeline for queue listeners.
+
+The listener thread drains its queue and appends the lines to the front
+buffer of a DoubleBufferedWriter. A writer thread swaps in the empty back
+buffer and writes out the full one with writev, so the queue keeps draining
+while the write is in flight, and many lines go out per syscall. A buffer
+is a list of the lines themselves; appending to a bytearray instead costs
+more than the write it saves.
+"""
+import logging
+import os
+import threading
+import time
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+
+def write_all(fd, chunks):
+    """
+    Write a list of bytes-like chunks with as few writev calls as possible,
+    picking up after short writes.
+    """
+    while chunks:
+        batch = chunks[:IOV_MAX]
+        written = os.writev(fd, batch)
+        done = 0
+        while done < len(batch) and written >= len(batch[done]):
+            written -= len(batch[done])
+            done += 1
+        chunks = chunks[done:]
+        if written:
+            chunks[0] = memoryview(chunks[0])[written:]
+
+
+def drain(queue, max_items=1024):
+    """
+    Block for one item, then take whatever else is ready without blocking,
+    up to max_items in all.
+    """
+    items = [queue.get()]
+    while len(items) < max_items and not queue.empty():
+        items.append(queue.get())
+    return items
+
+
+class DoubleBufferedWriter:
+    """
+    A file-like sink for a path or a file descriptor whose write() only
+    appends to an in-memory buffer.
+
+    The writer thread writes the buffer out once it holds high_water bytes,
+    or max_delay_s after the oldest unwritten line came in. write() blocks
+    while max_buffer bytes are waiting on a write in flight. flush() does
+    not wait, so that a StreamHandler flushing after every record does not
+    undo the coalescing; sync() waits until everything written so far is
+    out, and close() does the same before stopping the writer thread.
+    Errors from the writer thread are raised by the next call.
+    """
+
+    def __init__(self, target, high_water=1024 * 1024, max_buffer=8 * 1024 * 1024, max_delay_s=0.05):
+        if isinstance(target, int):
+            self.fd = target
+            self._own_fd = False
+        else:
+            self.fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._own_fd = True
+        self.high_water = high_water
+        self.max_buffer = max_buffer
+        self.max_delay_s = max_delay_s
+        self.writes = 0
+        self.bytes_written = 0
+        self._front = []
+        self._front_bytes = 0
+        self._front_since = 0.0
+        self._busy = False
+        self._syncing = 0
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='DoubleBufferedWriter', daemon=True)
+        self._thread.start()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.writelines([data])
+        return len(data)
+
+    def writelines(self, lines):
+        """
+        Append a list of bytes; a listener that drained a batch hands it
+        over with one call, taking the lock once.
+        """
+        size = sum(map(len, lines))
+        with self._cond:
+            self._check()
+            while self._front_bytes >= self.max_buffer and self._busy:
+                self._cond.wait()
+            if not self._front:
+                # Start the writer's max_delay_s clock.
+                self._front_since = time.monotonic()
+                self._cond.notify_all()
+            self._front += lines
+            self._front_bytes += size
+            if self._front_bytes >= self.high_water:
+                self._cond.notify_all()
+
+    def flush(self):
+        if self._error is not None:
+            with self._cond:
+                self._check()
+
+    def sync(self):
+        with self._cond:
+            self._syncing += 1
+            self._cond.notify_all()
+            try:
+                while self._front or self._busy:
+                    self._cond.wait()
+            finally:
+                self._syncing -= 1
+            self._check()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self._own_fd:
+            os.close(self.fd)
+        self._check()
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not (self._front and (self._front_bytes >= self.high_water
+                                            or self._syncing or self._closed)):
+                    if self._closed:
+                        return
+                    if not self._front:
+                        cond.wait()
+                        continue
+                    remaining = self._front_since + self.max_delay_s - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    cond.wait(remaining)
+                buf, size = self._front, self._front_bytes
+                self._front, self._front_bytes = [], 0
+                self._busy = True
+                cond.notify_all()
+            try:
+                write_all(self.fd, buf)
+            except OSError as e:
+                self._error = e
+                size = 0
+            with cond:
+                self.writes += 1
+                self.bytes_written += size
+                self._busy = False
+                cond.notify_all()
+
+
+class DoubleBufferedFileHandler(logging.StreamHandler):
+    """
+    A StreamHandler writing to path through a DoubleBufferedWriter.
+    """
+
+    def __init__(self, path, **kwargs):
+        logging.StreamHandler.__init__(self, DoubleBufferedWriter(path, **kwargs))
+
+    def close(self):
+        with self.lock:
+            try:
+                self.stream.close()
+            finally:
+                logging.StreamHandler.close(self)
@@ -3,9 +3,19 @@ import sys
 import multiprocessing as mp
 from concurrent.futures import ProcessPoolExecutor
 import logging
+import os
+import re
 import time
 
-big_line = '*' * 10_000
+from dedup import SUMMARY
+from framing import FRAME_MAGIC, FrameReassembler, FramedStreamHandler
+from locks import TicketLock
+from mp_handler import MultiProcessingStreamHandler, handler_kwargs_from_argv
+
+big_line = '*' * int(os.environ.get('LINE_LENGTH', 10_000))
+
+# A --dedup summary line, standing for that many more lines.
+summary_line = re.compile(re.escape(SUMMARY).replace('%d', r'(\d+)').encode())
 
 def current_milli_time():
     return time.time_ns() // 1_000_000
@@ -19,18 +29,27 @@ def single_producer():
     except BrokenPipeError:
         pass
 
-def init_logger(log_lock):
-    handler = MultiProcessingStreamHandler(log_lock, stream=sys.stdout)
+def init_logger(log_lock, kwargs):
+    handler = MultiProcessingStreamHandler(log_lock, stream=sys.stdout, **kwargs)
     logging.basicConfig(level=logging.INFO, format="%(message)s", force=True, handlers=[handler])
 
+def init_framed_logger():
+    logging.basicConfig(level=logging.INFO, format="%(message)s", force=True,
+                        handlers=[FramedStreamHandler(sys.stdout)])
+
 def run_producer():
     mp_context = mp.get_context("forkserver")
     futures = []
     max_workers = 8
+    if '--framed' in sys.argv:
+        initializer, initargs = init_framed_logger, ()
+    else:
+        lock = TicketLock(mp_context) if '--ticket' in sys.argv else mp_context.RLock()
+        initializer, initargs = init_logger, (lock, handler_kwargs_from_argv(sys.argv))
     try:
         with ProcessPoolExecutor(max_workers,
-                                 initializer=init_logger,
-                                 initargs=(mp_context.RLock(),),
+                                 initializer=initializer,
+                                 initargs=initargs,
                                  mp_context=mp_context) as executor:
             for _ in range(max_workers):
                 fut = executor.submit(single_producer)
@@ -42,32 +61,75 @@ def run_producer():
     except BrokenPipeError:
         pass
 
+def check_lines(data):
+    """
+    Check a block of complete, newline-terminated lines.
+
+    Returns (ok, garbled, unexpected) where ok counts lines of exactly
+    len(big_line) stars and the repeats dedup summary lines stand for,
+    garbled counts star lines of any other length and unexpected is the
+    first line holding anything else, or None.
+    """
+    line_count = data.count(b'\n')
+    stride = len(big_line) + 1
+    if (len(data) == line_count * stride
+            and data[len(big_line)::stride].count(b'\n') == line_count
+            and not data.translate(None, b'*\n')):
+        return line_count, 0, None
+    ok = garbled = 0
+    for line in data.split(b'\n')[:line_count]:
+        line = line.strip()
+        if line.translate(None, b'*'):
+            repeated = summary_line.fullmatch(line)
+            if repeated is None:
+                return ok, garbled, line
+            ok += int(repeated.group(1))
+            continue
+        if len(line) == len(big_line):
+            ok += 1
+        else:
+            garbled += 1
+    return ok, garbled, None
+
 def run_consumer():
     bad_line_count = 0
     ok_line_count = 0
     total_lines = 0
-    start_time = current_milli_time()
+    total_bytes = 0
+    start_time = time.perf_counter()
+    reassembler = None
     try:
         print(f'Line length is {len(big_line):_}', flush=True)
-        for line in sys.stdin:
-            line = line.strip()
-            total_lines += 1
-            all_stars = '*' * len(line)
-            if line == all_stars:
-                if len(line) == len(big_line):
-                    ok_line_count += 1
-                else:
-                    bad_line_count += 1
-            else:
-                print(f'Got unexpected line: {line}', flush=True)
+        stdin = sys.stdin.buffer
+        pending = b''
+        if stdin.peek(1)[:1] == bytes([FRAME_MAGIC]):
+            print('Reading framed records', flush=True)
+            reassembler = FrameReassembler()
+        while True:
+            chunk = stdin.read1(1024 * 1024)
+            if not chunk:
+                # A last line without a trailing newline is still a line.
+                chunk = b'\n' if pending else b''
+                if not chunk:
+                    break
+            total_bytes += len(chunk)
+            if reassembler is not None:
+                chunk = reassembler.feed(chunk)
+            data = pending + chunk if pending else chunk
+            cut = data.rfind(b'\n') + 1
+            pending = data[cut:]
+            ok, garbled, unexpected = check_lines(data[:cut] if cut < len(data) else data)
+            ok_line_count += ok
+            bad_line_count += garbled
+            if unexpected is not None:
+                print(f'Got unexpected line: {unexpected.decode(errors="replace")}', flush=True)
                 sys.exit(1)
-            if total_lines % 10_000 == 0:
-                spent_ms = current_milli_time() - start_time
-                spent_ms = spent_ms // 1000
-                if spent_ms == 0:
-                    spent_ms = 1
-                lines_per_ms = total_lines // spent_ms
-                msg = f'OK line count: {ok_line_count:_}, garbled line count: {bad_line_count:_}, lines/ms: {lines_per_ms:_}'
+            last_report = total_lines // 10_000
+            total_lines += ok + garbled
+            if total_lines // 10_000 != last_report:
+                spent_s = time.perf_counter() - start_time
+                msg = (f'OK line count: {ok_line_count:_}, garbled line count: {bad_line_count:_}, '
+                       f'lines/s: {total_lines / spent_s:_.1f}, MB/s: {total_bytes / spent_s / 1_000_000:_.1f}')
                 print(msg, flush=True)
         print('Stdin closed', flush=True)
     except BrokenPipeError:
@@ -79,6 +141,9 @@ def run_consumer():
             print('Consumer exiting', flush=True)
             print(f'OK line count: {ok_line_count:_}', flush=True)
             print(f'Bad line count: {bad_line_count:_}', flush=True)
+            if reassembler is not None:
+                print(f'Frame sequence gaps: {reassembler.gaps:_}, '
+                      f'incomplete records: {reassembler.incomplete():_}', flush=True)
         except BrokenPipeError:
             pass
 
@@ -92,85 +157,3 @@ if __name__ == "__main__":
     else:
         print('Unknown mode, exiting', flush=True)
         sys.exit(1)
-
-from types import GenericAlias
-
-class MultiProcessingStreamHandler(logging.Handler):
-    """
-    A handler class which writes logging records, appropriately formatted,
-    to a stream. Note that this class does not close the stream, as
-    sys.stdout or sys.stderr may be used.
-    """
-
-    terminator = "\n"
-
-    def __init__(self, multiprocess_lock, stream=sys.stdout):
-        """
-        Initialize the handler.
-
-        If stream is not specified, sys.stderr is used.
-        """
-        logging.Handler.__init__(self)
-        assert isinstance(multiprocess_lock, mp.synchronize.RLock)
-        self.multiprocess_lock = multiprocess_lock
-        self.stream = stream
-
-    def flush(self):
-        """
-        Flushes the stream.
-        """
-        with self.multiprocess_lock:
-            with self.lock:
-                if self.stream and hasattr(self.stream, "flush"):
-                    self.stream.flush()
-
-    def emit(self, record):
-        """
-        Emit a record.
-
-        If a formatter is specified, it is used to format the record.
-        The record is then written to the stream with a trailing newline.  If
-        exception information is present, it is formatted using
-        traceback.print_exception and appended to the stream.  If the stream
-        has an 'encoding' attribute, it is used to determine how to do the
-        output to the stream.
-        """
-        try:
-            with self.multiprocess_lock:
-                msg = self.format(record)
-                stream = self.stream
-                # issue 35046: merged two stream.writes into one.
-                stream.write(msg + self.terminator)
-                self.flush()
-        except RecursionError:  # See issue 36272
-            raise
-        except Exception:
-            self.handleError(record)
-
-    def setStream(self, stream):
-        """
-        Sets the StreamHandler's stream to the specified value,
-        if it is different.
-
-        Returns the old stream, if the stream was changed, or None
-        if it wasn't.
-        """
-        if stream is self.stream:
-            result = None
-        else:
-            result = self.stream
-            with self.lock:
-                self.flush()
-                self.stream = stream
-        return result
-
-    def __repr__(self):
-        level = getLevelName(self.level)
-        name = getattr(self.stream, "name", "")
-        #  bpo-36015: name can be an int
-        name = str(name)
-        if name:
-            name += " "
-        return "<%s %s(%s)>" % (self.__class__.__name__, name, level)
-
-    __class_getitem__ = classmethod(GenericAlias)
@@ -8,7 +8,7 @@ PYTHON_EXECUTEABLE="${PYTHON_EXECUTEABLE:-python3}"
 echo "Using python3 located at: $(which "${PYTHON_EXECUTEABLE}")"
 echo "Version: $("${PYTHON_EXECUTEABLE}" --version)"
 
-"${PYTHON_EXECUTEABLE}" -u ./fix.py --producer | \
+"${PYTHON_EXECUTEABLE}" -u ./fix.py --producer "$@" | \
 bash -c "
 onEXIT () {
   EXIT_STATUS=\$?
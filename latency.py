@@ -0,0 +1,146 @@
+"""
+Log-bucketed latency histograms merged across processes.
+
+Every power of two is split into SUB_BUCKETS linear buckets, so a recorded
+value is off by at most 1/SUB_BUCKETS (12.5 %). Recording is a bit_length,
+a shift and a list increment.
+"""
+import multiprocessing as mp
+import os
+import time
+from multiprocessing import util
+
+SUB_BITS = 3
+SUB_BUCKETS = 1 << SUB_BITS
+BUCKETS = 64 * SUB_BUCKETS
+
+
+def bucket_index(ns):
+    if ns < SUB_BUCKETS:
+        return max(ns, 0)
+    exp = ns.bit_length() - 1
+    return (exp - SUB_BITS + 1) * SUB_BUCKETS + ((ns >> (exp - SUB_BITS)) & (SUB_BUCKETS - 1))
+
+
+def bucket_upper(index):
+    """
+    The largest value that lands in bucket index.
+    """
+    if index < SUB_BUCKETS:
+        return index
+    exp = index // SUB_BUCKETS + SUB_BITS - 1
+    sub = index % SUB_BUCKETS
+    return ((SUB_BUCKETS + sub + 1) << (exp - SUB_BITS)) - 1
+
+
+def since_ns(created):
+    """
+    Nanoseconds from created, a LogRecord.created timestamp, until now.
+    """
+    return time.time_ns() - int(created * 1e9)
+
+
+class LatencyHistogram:
+    """
+    A histogram of latencies in nanoseconds, local to one process.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def record(self, ns):
+        self.counts[bucket_index(ns)] += 1
+        self.count += 1
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th percentile, capped at max.
+        """
+        if not self.count:
+            return 0
+        rank = q / 100 * self.count
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(bucket_upper(index), self.max)
+        return self.max
+
+    def summary(self):
+        return dict(count=self.count,
+                    p50_us=self.percentile(50) / 1000,
+                    p99_us=self.percentile(99) / 1000,
+                    p999_us=self.percentile(99.9) / 1000,
+                    max_us=self.max / 1000)
+
+    def format(self, name='latency'):
+        s = self.summary()
+        return (f'{name}: count: {s["count"]:_}, p50 us: {s["p50_us"]:_.1f}, p99 us: {s["p99_us"]:_.1f}, '
+                f'p999 us: {s["p999_us"]:_.1f}, max us: {s["max_us"]:_.1f}')
+
+
+class SharedLatencyHistogram:
+    """
+    A latency histogram shared by all processes it is passed to.
+
+    record() only touches a histogram local to the calling process. That
+    histogram is merged into shared memory by export(), which runs
+    automatically when the process exits through multiprocessing, or when a
+    plain Python process shuts down.
+    """
+
+    def __init__(self, ctx=mp):
+        # BUCKETS counts, then the total count and the max.
+        self.array = ctx.Array('Q', BUCKETS + 2)
+        self._local = None
+        self._pid = None
+
+    def __getstate__(self):
+        return self.array
+
+    def __setstate__(self, state):
+        self.array = state
+        self._local = None
+        self._pid = None
+
+    def _local_histogram(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = LatencyHistogram()
+            util.Finalize(self, self.export, exitpriority=10)
+        return self._local
+
+    def record(self, ns):
+        self._local_histogram().record(ns)
+
+    def record_since(self, created):
+        self._local_histogram().record(since_ns(created))
+
+    def export(self):
+        local = self._local
+        if local is None or not local.count:
+            return
+        with self.array.get_lock():
+            for index, n in enumerate(local.counts):
+                if n:
+                    self.array[index] += n
+            self.array[BUCKETS] += local.count
+            self.array[BUCKETS + 1] = max(self.array[BUCKETS + 1], local.max)
+        self._local = LatencyHistogram()
+
+    def snapshot(self):
+        """
+        A LatencyHistogram of everything exported so far.
+        """
+        self.export()
+        hist = LatencyHistogram()
+        with self.array.get_lock():
+            values = self.array[:]
+        hist.counts = values[:BUCKETS]
+        hist.count = values[BUCKETS]
+        hist.max = values[BUCKETS + 1]
+        return hist
@@ -0,0 +1,228 @@
+"""
+Cross-process locks for MultiProcessingStreamHandler.
+"""
+import multiprocessing as mp
+import os
+import threading
+import time
+
+# Ticket lock words: next ticket to hand out, ticket now being served, then
+# one sleeping flag per wakeup slot.
+NEXT_TICKET = 0
+NOW_SERVING = 1
+SLEEPING = 2
+
+# Per-thread stats slot: pid, native thread id, acquisitions, total wait ns,
+# total hold ns, longest wait ns.
+SLOT_FIELDS = 6
+
+
+class InstrumentedLock:
+    """
+    Wraps a multiprocessing lock and records, per process and thread, how
+    often it was acquired, the time spent waiting for it and holding it, and
+    the longest wait.
+
+    Every thread owns a slot in a shared array and is the only writer of
+    that slot, so recording takes no extra lock, and snapshot() can be
+    called from any process while the lock is in use. Only the outermost
+    acquisition of a reentrant lock is counted. When stats are not wanted,
+    pass the bare lock to the handler instead; then there is no overhead
+    at all.
+    """
+
+    def __init__(self, lock, ctx=mp, max_slots=256):
+        self._lock = lock
+        self.max_slots = max_slots
+        self._stats = ctx.RawArray('q', max_slots * SLOT_FIELDS)
+        self._next_slot = ctx.Value('i', 0)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return self._lock, self.max_slots, self._stats, self._next_slot
+
+    def __setstate__(self, state):
+        self._lock, self.max_slots, self._stats, self._next_slot = state
+        self._local = threading.local()
+
+    def _thread_state(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            with self._next_slot.get_lock():
+                slot = min(self._next_slot.value, self.max_slots - 1)
+                self._next_slot.value += 1
+            local.pid = os.getpid()
+            local.base = slot * SLOT_FIELDS
+            local.depth = 0
+            local.acquired_at = 0
+            self._stats[local.base] = os.getpid()
+            self._stats[local.base + 1] = threading.get_native_id()
+        return local
+
+    def acquire(self, block=True, timeout=None):
+        start = time.perf_counter_ns()
+        if not self._lock.acquire(block, timeout):
+            return False
+        now = time.perf_counter_ns()
+        local = self._thread_state()
+        if local.depth == 0:
+            stats = self._stats
+            base = local.base
+            wait = now - start
+            stats[base + 2] += 1
+            stats[base + 3] += wait
+            if wait > stats[base + 5]:
+                stats[base + 5] = wait
+            local.acquired_at = now
+        local.depth += 1
+        return True
+
+    def release(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0:
+            self._stats[local.base + 4] += time.perf_counter_ns() - local.acquired_at
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        return self.release()
+
+    def snapshot(self):
+        """
+        The stats of every thread that has used the lock so far, as a list
+        of dicts.
+        """
+        used = min(self._next_slot.value, self.max_slots)
+        values = self._stats[:used * SLOT_FIELDS]
+        result = []
+        for base in range(0, len(values), SLOT_FIELDS):
+            pid, tid, acquisitions, wait_ns, hold_ns, max_wait_ns = values[base:base + SLOT_FIELDS]
+            result.append(dict(pid=pid, thread=tid, acquisitions=acquisitions,
+                               wait_ms=wait_ns / 1e6, hold_ms=hold_ns / 1e6,
+                               max_wait_us=max_wait_ns / 1e3))
+        return result
+
+    def format(self):
+        lines = []
+        for s in self.snapshot():
+            lines.append(f'pid {s["pid"]} thread {s["thread"]}: acquisitions: {s["acquisitions"]:_}, '
+                         f'wait ms: {s["wait_ms"]:_.1f}, hold ms: {s["hold_ms"]:_.1f}, '
+                         f'max wait us: {s["max_wait_us"]:_.1f}')
+        return '\n'.join(lines)
+
+
+class TicketLock:
+    """
+    A reentrant lock shared between processes that is granted in FIFO
+    order.
+
+    mp.RLock is a POSIX semaphore, which makes no promise about which
+    waiter wakes up first, so a busy producer can take it again and again
+    while others starve. Here every acquirer draws a ticket and waits until
+    the now-serving counter reaches it. Drawing a ticket takes a short
+    internal lock; the lock itself is handed over by release() bumping the
+    counter, which only the holder writes.
+
+    A waiter first polls the counter spins times, yielding the CPU between
+    polls, then flags its slot as sleeping and blocks on the slot's
+    semaphore, which release() posts for the next ticket only. Tickets map
+    onto slots round-robin. A missed or stray wakeup costs at most
+    max_sleep_s, as the wait is timed and always rechecks the counter. A
+    ticket cannot be handed back, so timeouts are not supported, and a wait
+    interrupted by an exception such as KeyboardInterrupt still waits for
+    its ticket and passes it on before raising.
+
+    Like the multiprocessing locks it must reach other processes through
+    inheritance, for example as a pool initarg; that works with every start
+    method, forkserver included.
+    """
+
+    def __init__(self, ctx=mp, spins=20, slots=64, max_sleep_s=0.01):
+        self._words = ctx.RawArray('q', SLEEPING + slots)
+        self._dispenser = ctx.Lock()
+        self._wakeups = [ctx.Semaphore(0) for _ in range(slots)]
+        self.spins = spins
+        self.max_sleep_s = max_sleep_s
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return self._words, self._dispenser, self._wakeups, self.spins, self.max_sleep_s
+
+    def __setstate__(self, state):
+        self._words, self._dispenser, self._wakeups, self.spins, self.max_sleep_s = state
+        self._local = threading.local()
+
+    def _thread_state(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.depth = 0
+        return local
+
+    def acquire(self, block=True, timeout=None):
+        if timeout is not None:
+            raise ValueError('TicketLock does not support timeouts')
+        local = self._thread_state()
+        if local.depth:
+            local.depth += 1
+            return True
+        words = self._words
+        with self._dispenser:
+            ticket = words[NEXT_TICKET]
+            if not block and words[NOW_SERVING] != ticket:
+                return False
+            words[NEXT_TICKET] = ticket + 1
+        try:
+            self._wait_for(ticket)
+        except BaseException:
+            # Every later ticket waits for this one to be served.
+            while True:
+                try:
+                    self._wait_for(ticket)
+                    break
+                except BaseException:
+                    pass
+            self._serve_next()
+            raise
+        local.depth = 1
+        return True
+
+    def _wait_for(self, ticket):
+        words = self._words
+        spins = self.spins
+        while words[NOW_SERVING] != ticket:
+            if spins:
+                spins -= 1
+                os.sched_yield()
+                continue
+            slot = ticket % len(self._wakeups)
+            words[SLEEPING + slot] = 1
+            if words[NOW_SERVING] != ticket:
+                self._wakeups[slot].acquire(timeout=self.max_sleep_s)
+            words[SLEEPING + slot] = 0
+
+    def release(self):
+        local = self._thread_state()
+        if not local.depth:
+            raise RuntimeError('cannot release un-acquired lock')
+        local.depth -= 1
+        if local.depth == 0:
+            self._serve_next()
+
+    def _serve_next(self):
+        words = self._words
+        serving = words[NOW_SERVING] + 1
+        words[NOW_SERVING] = serving
+        slot = serving % len(self._wakeups)
+        if words[SLEEPING + slot]:
+            words[SLEEPING + slot] = 0
+            self._wakeups[slot].release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        return self.release()
@@ -0,0 +1,170 @@
+"""
+A log file that many processes append to without a shared write lock.
+
+The log is split into pre-sized segment files, base.000000, base.000001, ...
+A writer reserves a byte range in the current segment by advancing a shared
+offset, then copies its record into that range through a memory map. The
+range stays zero-filled until the record is published: the writer stores
+every byte but the first, then the first, so a reader that stops at the
+first NUL byte only ever sees complete lines. That relies on stores becoming
+visible in program order, as they do on x86, and on records not containing
+NUL bytes.
+
+Python has no atomic fetch-and-add on shared memory, so the reservation is a
+few integer operations under a short mp.Lock; the copy, which is where the
+time goes, takes no lock.
+"""
+import logging
+import mmap
+import multiprocessing as mp
+import os
+
+# Shared words: index of the current segment, bytes reserved in it.
+SEGMENT = 0
+OFFSET = 1
+
+
+def segment_path(base, index):
+    return f'{base}.{index:06d}'
+
+
+def segment_paths(base):
+    """
+    Paths of the existing segments of base, in order.
+    """
+    paths = []
+    while os.path.exists(segment_path(base, len(paths))):
+        paths.append(segment_path(base, len(paths)))
+    return paths
+
+
+def create_segment(path, size):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def published(data):
+    """
+    The published prefix of segment contents: everything before the first
+    record that has not been published yet.
+    """
+    end = data.find(b'\0')
+    return data if end == -1 else data[:end]
+
+
+def join_segments(base, dest, remove=False):
+    """
+    Append the published lines of every segment of base to dest, and return
+    the number of bytes appended.
+    """
+    total = 0
+    with open(dest, 'ab') as out:
+        for path in segment_paths(base):
+            with open(path, 'rb') as fd:
+                data = published(fd.read())
+            out.write(data)
+            total += len(data)
+            if remove:
+                os.remove(path)
+    return total
+
+
+class SegmentLog:
+    """
+    The shared state of a segmented log. Create it in the parent and pass it
+    to the producer processes, which each write through a SegmentHandler.
+    """
+
+    def __init__(self, base, segment_size=64 * 1024 * 1024, ctx=mp):
+        self.base = base
+        self.segment_size = segment_size
+        self._words = ctx.RawArray('q', 2)
+        self._reserve_lock = ctx.Lock()
+        for path in segment_paths(base):
+            os.remove(path)
+        create_segment(segment_path(base, 0), segment_size)
+
+    def reserve(self, n):
+        """
+        Reserve n bytes and return (segment index, offset). When the current
+        segment cannot hold n more bytes it is truncated to what was reserved
+        in it and the log rolls to a new segment.
+        """
+        if n > self.segment_size:
+            raise ValueError(f'Record of {n:_} bytes does not fit in a segment of {self.segment_size:_} bytes')
+        words = self._words
+        with self._reserve_lock:
+            segment = words[SEGMENT]
+            offset = words[OFFSET]
+            if offset + n > self.segment_size:
+                os.truncate(segment_path(self.base, segment), offset)
+                segment += 1
+                create_segment(segment_path(self.base, segment), self.segment_size)
+                words[SEGMENT] = segment
+                offset = 0
+            words[OFFSET] = offset + n
+        return segment, offset
+
+    def close(self):
+        """
+        Truncate the current segment to what was reserved in it. Call once
+        every writer is done.
+        """
+        with self._reserve_lock:
+            os.truncate(segment_path(self.base, self._words[SEGMENT]), self._words[OFFSET])
+
+
+class SegmentHandler(logging.Handler):
+    """
+    A handler that writes records into a SegmentLog.
+
+    Each process maps the segment it is writing to; writers in different
+    processes copy into their own reserved ranges in parallel. If latency is
+    a latency.SharedLatencyHistogram, the time from record creation until
+    the record has been published is recorded in it.
+    """
+
+    terminator = '\n'
+
+    def __init__(self, log, latency=None):
+        logging.Handler.__init__(self)
+        self.log = log
+        self.latency = latency
+        self._segment = None
+        self._mmap = None
+
+    def _map(self, segment):
+        # Reservations only move forward, so an older mapping is never
+        # needed again.
+        if segment != self._segment:
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(segment_path(self.log.base, segment), 'r+b') as fd:
+                self._mmap = mmap.mmap(fd.fileno(), 0)
+            self._segment = segment
+        return self._mmap
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + self.terminator).encode()
+            segment, offset = self.log.reserve(len(data))
+            mm = self._map(segment)
+            mm[offset + 1:offset + len(data)] = data[1:]
+            mm[offset] = data[0]
+            if self.latency is not None:
+                self.latency.record_since(record.created)
+        except RecursionError:  # See issue 36272
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        with self.lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+                self._segment = None
+        logging.Handler.close(self)
@@ -0,0 +1,391 @@
+"""
+MultiProcessingStreamHandler, shared by fix.py, race_threads_mp_rlock.py and
+bench.py.
+"""
+import collections
+import fcntl
+import logging
+import multiprocessing as mp
+import os
+import stat
+import sys
+import time
+import weakref
+from types import GenericAlias
+
+from batching import AgeFlusher, flush_at_exit
+from dedup import DedupMixin
+from locks import InstrumentedLock, TicketLock
+
+
+class MultiProcessingStreamHandler(DedupMixin, logging.Handler):
+    """
+    A handler class which writes logging records, appropriately formatted,
+    to a stream. Note that this class does not close the stream, as
+    sys.stdout or sys.stderr may be used.
+
+    Optionally records are group-committed: each process collects formatted
+    records in a local buffer and takes the multiprocess lock once per batch.
+    A batch is written when it holds batch_records records, batch_bytes
+    characters, or when its oldest record is batch_max_age_ms old. Limits
+    left unset do not apply; batch_records defaults to one record, no
+    batching, unless another limit is set.
+
+    flush_policy picks when buffered records are written out:
+
+    record:   every record is written as it is emitted (the default).
+    bytes:    when flush_bytes characters are buffered.
+    interval: every flush_interval_ms milliseconds, by a background thread.
+    error:    when a record of level ERROR or above is emitted, or when
+              flush_bytes characters are buffered, whichever comes first.
+
+    Buffers only ever hold complete lines and are written on flush(),
+    close(), setStream() and when a multiprocessing worker exits. A child
+    created by fork() drops the buffer it inherited, since the parent still
+    owns those records.
+
+    With atomic_append=True records written to a regular file opened with
+    O_APPEND skip the multiprocess lock and go out with a single os.write,
+    which is atomic for such a file. Other streams take the lock as usual.
+    That includes pipes: only writes of up to PIPE_BUF bytes are atomic on
+    a pipe, and a larger record written in pieces under the lock would let
+    another process's lock-free write land inside it. Use the framed mode
+    for lock-free writes to a pipe.
+
+    If latency is a latency.SharedLatencyHistogram, the time from record
+    creation until the record has been written is recorded in it.
+
+    multiprocess_lock may be a locks.TicketLock instead of the RLock, which
+    grants the lock in FIFO order, and either may be wrapped in a
+    locks.InstrumentedLock to collect wait and hold times.
+
+    With combine=True the threads of a process combine their writes: each
+    thread formats its record without any lock and publishes it to a queue
+    local to the process, then takes the handler lock. The thread that gets
+    it writes every published record, its own and those of the threads
+    still waiting, under a single acquisition of the multiprocess lock;
+    threads whose record was written meanwhile return at once. Every call
+    still returns only after its record has been written. atomic_append and
+    batching take precedence over combining.
+
+    With dedup=True consecutive identical records of a logger are collapsed
+    into the first one and a "Last message repeated N times" summary, sent
+    after dedup_max_delay_ms at the latest; see dedup.py. The dedup stage
+    dispatches under the handler lock, which would leave nothing to
+    combine, so dedup and combine cannot be used together.
+
+    Records are formatted and encoded before the multiprocess lock is taken;
+    while it is held only the raw bytes are written to the file descriptor
+    of the stream. Streams without a file descriptor are written to through
+    their text layer under the lock instead.
+    """
+
+    terminator = "\n"
+
+    flush_policies = ('record', 'bytes', 'interval', 'error')
+
+    def __init__(self, multiprocess_lock, stream=sys.stderr,
+                 batch_records=None, batch_bytes=None, batch_max_age_ms=None,
+                 atomic_append=False, latency=None,
+                 flush_policy='record', flush_bytes=64 * 1024, flush_interval_ms=100,
+                 combine=False, dedup=False, dedup_max_delay_ms=1000):
+        """
+        Initialize the handler.
+
+        If stream is not specified, sys.stderr is used.
+
+        With no batch limits and the record flush policy every record is
+        written on its own, as before.
+        """
+        logging.Handler.__init__(self)
+        assert isinstance(multiprocess_lock, (mp.synchronize.RLock, InstrumentedLock, TicketLock))
+        self.multiprocess_lock = multiprocess_lock
+        self.stream = stream
+        if flush_policy not in self.flush_policies:
+            raise ValueError(f'Unknown flush policy: {flush_policy}')
+        if dedup and combine:
+            raise ValueError('dedup=True and combine=True cannot be used together')
+        self.flush_policy = flush_policy
+        if flush_policy in ('bytes', 'error') and batch_bytes is None:
+            batch_bytes = flush_bytes
+        elif flush_policy == 'interval' and batch_max_age_ms is None:
+            batch_max_age_ms = flush_interval_ms
+        self.batching = (batch_records or 1) > 1 or batch_bytes is not None or batch_max_age_ms is not None
+        if batch_records is None:
+            batch_records = sys.maxsize if self.batching else 1
+        self.batch_records = batch_records
+        self.batch_bytes = batch_bytes
+        self.batch_max_age = None if batch_max_age_ms is None else batch_max_age_ms / 1000
+        self.combine = combine and not atomic_append and not self.batching
+        self._pending = collections.deque()
+        if self.batching or self.combine:
+            _buffering_handlers.add(self)
+        if dedup:
+            self.init_dedup(dedup_max_delay_ms / 1000)
+        if self.batching or self.dedup is not None:
+            # Runs before latency histograms are exported.
+            self._finalizer = flush_at_exit(self)
+        else:
+            self._finalizer = None
+        self._batch = []
+        self._batch_created = []
+        self._batch_size = 0
+        self._flusher = None
+        if self.batch_max_age is not None:
+            self._flusher = AgeFlusher(self, self.batch_max_age, lambda: len(self._batch), self._write_batch)
+        self.atomic_append = atomic_append
+        self._fd = None
+        self._atomic = False
+        self.latency = latency
+
+    def flush(self):
+        """
+        Flushes the stream, writing any pending repeat summaries and batch
+        first.
+        """
+        self.drain_dedup()
+        with self.lock:
+            if self._batch:
+                self._write_batch()
+            if self.stream and hasattr(self.stream, "flush"):
+                self.stream.flush()
+
+    def _dispatch(self, record):
+        # When combining, emit() is called without the handler lock, which
+        # it takes itself once the record is formatted.
+        if self.combine:
+            self.emit(record)
+        else:
+            with self.lock:
+                self.emit(record)
+
+    def emit(self, record):
+        """
+        Emit a record.
+
+        If a formatter is specified, it is used to format the record.
+        The record is then written to the stream with a trailing newline.  If
+        exception information is present, it is formatted using
+        traceback.print_exception and appended to the stream.  If the stream
+        has an 'encoding' attribute, it is used to determine how to do the
+        output to the stream.
+        """
+        try:
+            if self.atomic_append:
+                self._emit_atomic(record)
+                return
+            if self.batching:
+                self._emit_batched(record)
+                return
+            if self.combine:
+                self._emit_combined(record)
+                return
+            # issue 35046: merged two stream.writes into one.
+            self._write(self.format(record) + self.terminator)
+            if self.latency is not None:
+                self.latency.record_since(record.created)
+        except RecursionError:  # See issue 36272
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _emit_batched(self, record):
+        msg = self.format(record) + self.terminator
+        with self.lock:
+            if not self._batch and self._flusher is not None:
+                self._flusher.batch_started()
+            self._batch.append(msg)
+            self._batch_created.append(record.created)
+            self._batch_size += len(msg)
+            if (len(self._batch) >= self.batch_records
+                    or (self.flush_policy == 'error' and record.levelno >= logging.ERROR)
+                    or (self.batch_bytes is not None and self._batch_size >= self.batch_bytes)
+                    or (self._flusher is not None and self._flusher.expired())):
+                self._write_batch()
+
+    def _emit_combined(self, record):
+        # entry[2] becomes True once the record is written, or the exception
+        # that the write raised, which every thread reports for its own record.
+        entry = [self.format(record) + self.terminator, record.created, False]
+        self._pending.append(entry)
+        with self.lock:
+            if entry[2] is False:
+                self._write_pending()
+        if entry[2] is not True:
+            raise entry[2]
+
+    def _emit_atomic(self, record):
+        msg = self.format(record) + self.terminator
+        fd = self._stream_fd()
+        if fd < 0:
+            self._write(msg)
+        else:
+            data = self._encode(msg)
+            if self._atomic:
+                written = os.write(fd, data)
+                if written < len(data):
+                    # A short write, e.g. on a full disk or after a signal:
+                    # write the rest under the lock.
+                    self._write_fd(fd, memoryview(data)[written:])
+            else:
+                self._write_fd(fd, data)
+        if self.latency is not None:
+            self.latency.record_since(record.created)
+
+    def _stream_fd(self):
+        """
+        Return the file descriptor of the stream, or -1 if it has none.
+
+        Also works out whether every write to it is atomic, for
+        atomic_append.
+        """
+        if self._fd is None:
+            with self.lock:
+                try:
+                    self.stream.flush()
+                    fd = self.stream.fileno()
+                except (AttributeError, OSError, ValueError):
+                    fd = -1
+                self._atomic = (fd >= 0 and stat.S_ISREG(os.fstat(fd).st_mode)
+                                and bool(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND))
+                self._fd = fd
+        return self._fd
+
+    def _encode(self, msg):
+        return msg.encode(getattr(self.stream, 'encoding', None) or 'utf-8',
+                          getattr(self.stream, 'errors', None) or 'strict')
+
+    def _write(self, msg):
+        """
+        Write msg, one or more complete lines, holding the multiprocess lock
+        only for the write itself.
+        """
+        fd = self._stream_fd()
+        if fd < 0:
+            with self.multiprocess_lock:
+                self.stream.write(msg)
+                if hasattr(self.stream, "flush"):
+                    self.stream.flush()
+        else:
+            self._write_fd(fd, self._encode(msg))
+
+    def _write_fd(self, fd, data):
+        view = memoryview(data)
+        with self.multiprocess_lock:
+            while view:
+                view = view[os.write(fd, view):]
+
+    def _write_batch(self):
+        """
+        Write the pending batch with a single stream write and flush.
+
+        Must be called with self.lock held.
+        """
+        data = ''.join(self._batch)
+        created = self._batch_created
+        self._batch.clear()
+        self._batch_created = []
+        self._batch_size = 0
+        self._write(data)
+        if self.latency is not None:
+            for c in created:
+                self.latency.record_since(c)
+
+    def _write_pending(self):
+        """
+        Write every published record, whichever thread published it, with a
+        single write, and mark each entry with the outcome.
+
+        Must be called with self.lock held.
+        """
+        pending = self._pending
+        entries = []
+        while pending:
+            entries.append(pending.popleft())
+        try:
+            self._write(''.join([entry[0] for entry in entries]))
+        except Exception as e:
+            for entry in entries:
+                entry[2] = e
+            return
+        for entry in entries:
+            entry[2] = True
+        if self.latency is not None:
+            for entry in entries:
+                self.latency.record_since(entry[1])
+
+    def close(self):
+        """
+        Writes any pending batch, then closes the handler.
+        """
+        try:
+            self.flush()
+        finally:
+            if self._finalizer is not None:
+                self._finalizer.cancel()
+            logging.Handler.close(self)
+
+    def setStream(self, stream):
+        """
+        Sets the StreamHandler's stream to the specified value,
+        if it is different.
+
+        Returns the old stream, if the stream was changed, or None
+        if it wasn't.
+        """
+        if stream is self.stream:
+            result = None
+        else:
+            result = self.stream
+            with self.lock:
+                self.flush()
+                self.stream = stream
+                self._fd = None
+        return result
+
+    def __repr__(self):
+        level = logging.getLevelName(self.level)
+        name = getattr(self.stream, "name", "")
+        #  bpo-36015: name can be an int
+        name = str(name)
+        if name:
+            name += " "
+        return "<%s %s(%s)>" % (self.__class__.__name__, name, level)
+
+    __class_getitem__ = classmethod(GenericAlias)
+
+_buffering_handlers = weakref.WeakSet()
+
+def _drop_buffers_after_fork():
+    # The parent still owns the records it buffered before the fork; writing
+    # them from the child as well would duplicate them.
+    for handler in _buffering_handlers:
+        handler._batch.clear()
+        handler._batch_created = []
+        handler._batch_size = 0
+        handler._pending.clear()
+
+os.register_at_fork(after_in_child=_drop_buffers_after_fork)
+
+def handler_kwargs_from_argv(argv):
+    """
+    MultiProcessingStreamHandler arguments for the --dedup, --batch, --atomic,
+    --combine and --flush=<policy> options. The last four each pick how
+    records are written, so at most one of them may be given, and --combine
+    excludes --dedup as well.
+    """
+    modes = [arg for arg in argv if arg in ('--batch', '--atomic', '--combine') or arg.startswith('--flush=')]
+    if len(modes) > 1:
+        sys.exit(f'{" and ".join(modes)} cannot be combined')
+    if '--dedup' in argv and '--combine' in argv:
+        sys.exit('--dedup and --combine cannot be combined')
+    kwargs = dict(dedup=True) if '--dedup' in argv else {}
+    if '--batch' in argv:
+        kwargs.update(batch_records=64, batch_bytes=1024 * 1024, batch_max_age_ms=50)
+    elif '--atomic' in argv:
+        kwargs.update(atomic_append=True)
+    elif '--combine' in argv:
+        kwargs.update(combine=True)
+    elif modes:
+        kwargs.update(flush_policy=modes[0].split('=', 1)[1])
+    return kwargs
@@ -2,8 +2,21 @@
 
 import logging
 import logging.handlers
+import functools
+import heapq
 import multiprocessing
 import os
+import queue
+import sys
+import zlib
+
+from batching import flush_at_exit
+from binlog import BinaryFileHandler
+from dedup import DedupMixin
+from double_buffer import DoubleBufferedFileHandler, drain
+from latency import SharedLatencyHistogram
+from mmap_segments import SegmentHandler, SegmentLog, segment_paths
+from rotating import SizeRotatingFileHandler
 
 import time
 
@@ -12,6 +25,11 @@ big_line = '*' * 10_000
 def current_milli_time():
     return time.time_ns() // 1_000_000
 
+# Shards written for a merge start every line with the record creation time,
+# fixed width so that lines sort by time.
+STAMPED_FORMAT = '%(created)017.6f %(message)s'
+STAMP_WIDTH = 18
+
 #
 # Because you'll want to define the logging configurations for listener and workers, the
 # listener and worker process functions take a configurer parameter which is a callable
@@ -22,39 +40,106 @@ def current_milli_time():
 # simple example, the listener does not apply level or filter logic to received records.
 # In practice, you would probably want to do this logic in the worker processes, to avoid
 # sending events which would be filtered out between processes.
-def listener_configurer():
+#
+# rollover picks the rotating handler: 'stock' is RotatingFileHandler, 'size'
+# is SizeRotatingFileHandler, which decides on rollover without formatting
+# twice or asking the file for its size, and 'background' also rotates in a
+# thread of its own. binary writes the binary format of binlog.py with its
+# time index instead of text.
+def listener_configurer(path='output.txt', stamped=False, pipelined=False, rollover='stock',
+                        max_bytes=100 * 1024 * 1024 * 1024, binary=False):
     root = logging.getLogger()
     for h in root.handlers[:]:
         root.removeHandler(h)
         h.close()
 
-    h = logging.handlers.RotatingFileHandler('output.txt', 'w', 100 * 1024 * 1024 * 1024, 10)
-    f = logging.Formatter('%(message)s')
+    if binary:
+        h = BinaryFileHandler(path)
+    elif pipelined:
+        # Writes go out from a writer thread, in large coalesced chunks.
+        open(path, 'w').close()
+        h = DoubleBufferedFileHandler(path)
+    elif rollover == 'stock':
+        h = logging.handlers.RotatingFileHandler(path, 'w', max_bytes, 10)
+    elif rollover in ('size', 'background'):
+        h = SizeRotatingFileHandler(path, 'w', max_bytes, 10, background=rollover == 'background')
+    else:
+        raise ValueError(f'Unknown rollover {rollover!r}, expected stock, size or background')
+    f = logging.Formatter(STAMPED_FORMAT if stamped else '%(message)s')
     h.setFormatter(f)
     root.addHandler(h)
 
+def shard_path(base, index):
+    return f'{base}.shard{index}'
+
+def reordered(lines, max_lag_s):
+    """
+    Yield stamped lines in time order, assuming none arrived more than
+    max_lag_s seconds after a line stamped later than it.
+    """
+    heap = []
+    newest = 0.0
+    for line in lines:
+        heapq.heappush(heap, line)
+        newest = max(newest, float(line[:STAMP_WIDTH]))
+        while float(heap[0][:STAMP_WIDTH]) < newest - max_lag_s:
+            yield heapq.heappop(heap)
+    while heap:
+        yield heapq.heappop(heap)
+
+def merge_shards(paths, dest, max_lag_s=2.0):
+    """
+    Merge stamped shards into dest in creation time order and drop the
+    stamps. A shard is in the order its listener received records, which
+    can lag creation order across producers, so each shard is first put in
+    order, holding back the lines of the last max_lag_s seconds. Assumes
+    one line per record.
+    """
+    files = [open(path, 'rb') for path in paths]
+    try:
+        with open(dest, 'wb') as out:
+            for line in heapq.merge(*(reordered(f, max_lag_s) for f in files)):
+                out.write(line[STAMP_WIDTH:])
+    finally:
+        for f in files:
+            f.close()
+
 # This is the listener process top-level loop: wait for logging events
 # (LogRecords)on the queue and handle them, quit when you get a None for a
-# LogRecord.
-def listener_process(queue, configurer):
+# LogRecord. With pipelined set it takes whatever records are ready at once,
+# and the configurer should set up a handler that writes from its own thread.
+def listener_process(queue, configurer, latency=None, pipelined=False):
     configurer()
     start_time_millis = current_milli_time()
     total_lines = 0
-    while True:
+    done = False
+    while not done:
         try:
-            record = queue.get()
-            if record is None:  # We send this as a sentinel to tell the listener to quit.
-                break
-            total_lines += 1
-            logger = logging.getLogger(record.name)
-            logger.handle(record)  # No level or filter logic applied - just do it!
+            records = drain(queue) if pipelined else [queue.get()]
+            for record in records:
+                if record is None:  # We send this as a sentinel to tell the listener to quit.
+                    done = True
+                    break
+                total_lines += 1
+                logger = logging.getLogger(record.name)
+                logger.handle(record)  # No level or filter logic applied - just do it!
+                if latency is not None:
+                    latency.record_since(record.created)
         except Exception:
             import sys, traceback
             print('Whoops! Problem:', file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
+    # The process leaves through os._exit, which skips logging's shutdown.
+    for h in logging.getLogger().handlers[:]:
+        h.close()
     total_ms = current_milli_time() - start_time_millis
     lines_per_ms = total_lines / total_ms
     print(f'{os.path.basename(__file__)}: total lines: {total_lines:_}, total ms: {total_ms:_}, lines/ms: {lines_per_ms:.2f}', flush=True)
+    if latency is not None:
+        # A pipelined listener hands records to the writer thread of its
+        # handler, so the time is taken before they are written.
+        label = 'enqueue-to-writer-thread latency' if pipelined else 'enqueue-to-write latency'
+        print(latency.snapshot().format(label), flush=True)
 
 # The worker configuration is done at the start of the worker process run.
 # Note that on Windows you can't rely on fork semantics, so each process
@@ -69,6 +154,184 @@ def worker_configurer(queue):
     # send all messages, for demo; no other level or filter logic applied.
     root.setLevel(logging.INFO)
 
+class DedupQueueHandler(DedupMixin, logging.handlers.QueueHandler):
+    """
+    A QueueHandler that enqueues consecutive identical records of a logger
+    once, followed by a "Last message repeated N times" summary within
+    max_delay_ms; see dedup.py.
+    """
+
+    def __init__(self, queue, max_delay_ms=1000):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.init_dedup(max_delay_ms / 1000)
+        # Runs before the queue's own finalizer closes it.
+        self._finalizer = flush_at_exit(self)
+
+    def flush(self):
+        self.drain_dedup()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._finalizer.cancel()
+            logging.handlers.QueueHandler.close(self)
+
+def dedup_worker_configurer(queue):
+    h = DedupQueueHandler(queue)
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    root.addHandler(h)
+    root.setLevel(logging.INFO)
+
+class OverflowCounters:
+    """
+    Counters shared by all BoundedQueueHandler instances, one per run.
+    """
+
+    def __init__(self, ctx=multiprocessing):
+        self.dropped = ctx.Value('Q', 0)
+        self.blocked_ns = ctx.Value('Q', 0)
+
+    def add_dropped(self, n=1):
+        with self.dropped.get_lock():
+            self.dropped.value += n
+
+    def add_blocked_ns(self, ns):
+        with self.blocked_ns.get_lock():
+            self.blocked_ns.value += ns
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler for a fixed-capacity queue that handles a full queue
+    according to an overflow policy instead of raising queue.Full:
+
+    block:       wait up to timeout seconds for room, then drop the record.
+    drop_newest: drop the record being logged.
+    drop_oldest: evict the oldest queued record to make room.
+    sample:      let every sample_every-th overflowing record through,
+                 waiting for room like block; drop the rest.
+
+    Dropped records and time spent blocked go to the shared counters.
+    """
+
+    policies = ('block', 'drop_newest', 'drop_oldest', 'sample')
+
+    def __init__(self, queue, counters, policy='block', timeout=1.0, sample_every=10):
+        if policy not in self.policies:
+            raise ValueError(f'Unknown overflow policy: {policy}')
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.counters = counters
+        self.policy = policy
+        self.timeout = timeout
+        self.sample_every = sample_every
+        self.overflowed = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        self.overflowed += 1
+        if self.policy == 'drop_newest':
+            self.counters.add_dropped()
+        elif self.policy == 'drop_oldest':
+            self._enqueue_evicting(record)
+        elif self.policy == 'sample' and self.overflowed % self.sample_every != 0:
+            self.counters.add_dropped()
+        else:
+            self._enqueue_blocking(record)
+
+    def _enqueue_blocking(self, record):
+        start = time.monotonic_ns()
+        try:
+            self.queue.put(record, True, self.timeout)
+        except queue.Full:
+            self.counters.add_dropped()
+        finally:
+            self.counters.add_blocked_ns(time.monotonic_ns() - start)
+
+    def _enqueue_evicting(self, record):
+        # The listener may drain the queue between the two calls, and records
+        # still in a feeder thread are not visible to get_nowait yet, so give
+        # up after a few rounds and drop the new record instead.
+        for _ in range(3):
+            try:
+                self.queue.get_nowait()
+                self.counters.add_dropped()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                pass
+        self.counters.add_dropped()
+
+class ShardedQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler over one queue per listener shard.
+
+    shard_by picks the queue: worker sends all records of a process to the
+    shard worker % len(queues), so consecutive worker numbers spread evenly
+    over the shards; logger sends all records of a logger to one shard,
+    chosen by a hash of its name that is the same in every process.
+    """
+
+    shard_keys = ('worker', 'logger')
+
+    def __init__(self, queues, shard_by='worker', worker=0):
+        if shard_by not in self.shard_keys:
+            raise ValueError(f'Unknown shard key: {shard_by}')
+        logging.handlers.QueueHandler.__init__(self, queues[0])
+        self.queues = queues
+        self.shard_by = shard_by
+        self.worker = worker
+        self._by_logger = {}
+
+    def enqueue(self, record):
+        if self.shard_by == 'worker':
+            shard = self.queues[self.worker % len(self.queues)]
+        else:
+            shard = self._by_logger.get(record.name)
+            if shard is None:
+                shard = self.queues[zlib.crc32(record.name.encode()) % len(self.queues)]
+                self._by_logger[record.name] = shard
+        shard.put_nowait(record)
+
+def sharded_worker_configurer(queue, queues, shard_by, worker):
+    h = ShardedQueueHandler(queues, shard_by, worker)
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    root.addHandler(h)
+    root.setLevel(logging.INFO)
+
+def bounded_worker_configurer(queue, policy, counters):
+    h = BoundedQueueHandler(queue, counters, policy)
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    root.addHandler(h)
+    root.setLevel(logging.INFO)
+
+# With --mmap there is no listener: every worker writes straight into the
+# segments of output.txt, output.txt.000000 and on.
+def segment_worker_configurer(queue, log, latency):
+    h = SegmentHandler(log, latency)
+    h.setFormatter(logging.Formatter('%(message)s'))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    root.addHandler(h)
+    root.setLevel(logging.INFO)
+
 def worker_process(producer_id, queue, configurer):
     configurer(queue)
     name = multiprocessing.current_process().name
@@ -96,20 +359,88 @@ def main():
     if os.path.exists('./output.txt'):
         os.remove('./output.txt')
         print('Removed ./output.txt', flush=True)
-    queue = multiprocessing.Queue(-1)
-    listener = multiprocessing.Process(target=listener_process,
-                                       args=(queue, listener_configurer))
-    listener.start()
+    modes = [arg for arg in sys.argv if arg.startswith(('--policy=', '--shards=')) or arg in ('--dedup', '--mmap')]
+    if len(modes) > 1:
+        sys.exit(f'{" and ".join(modes)} cannot be combined')
+    policy = next((arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--policy=')), None)
+    counters = None
+    configurer = worker_configurer
+    if policy is None:
+        queue = multiprocessing.Queue(-1)
+        if '--dedup' in sys.argv:
+            configurer = dedup_worker_configurer
+    else:
+        queue = multiprocessing.Queue(10_000)
+        counters = OverflowCounters()
+        configurer = functools.partial(bounded_worker_configurer, policy=policy, counters=counters)
+    latency = SharedLatencyHistogram() if '--latency' in sys.argv else None
+    shards = int(next((arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--shards=')), 0))
+    shard_by = next((arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--shard-by=')), 'worker')
+    merge = '--merge' in sys.argv
+    pipelined = '--pipeline' in sys.argv
+    rollover = next((arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--rollover=')), 'stock')
+    max_bytes = int(next((arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--max-bytes=')),
+                         100 * 1024 * 1024 * 1024))
+    binary = '--binary' in sys.argv
+    if binary and merge:
+        sys.exit('--merge needs text shards, it cannot be combined with --binary')
+    output = 'output.bin' if binary else 'output.txt'
+    segments = None
+    listeners = []
+    queues = [queue]
+    if '--mmap' in sys.argv:
+        segments = SegmentLog('output.txt')
+        configurer = functools.partial(segment_worker_configurer, log=segments, latency=latency)
+    elif shards:
+        # One listener, queue and output shard each; the workers pick a
+        # queue per record.
+        queues = [multiprocessing.Queue(-1) for _ in range(shards)]
+        configurer = functools.partial(sharded_worker_configurer, queues=queues, shard_by=shard_by)
+        for i, shard_queue in enumerate(queues):
+            shard_configurer = functools.partial(listener_configurer, shard_path(output, i), merge, pipelined,
+                                                 rollover, max_bytes, binary)
+            listeners.append(multiprocessing.Process(target=listener_process,
+                                                     args=(shard_queue, shard_configurer, latency, pipelined)))
+    else:
+        configurer_ = functools.partial(listener_configurer, output, pipelined=pipelined, rollover=rollover,
+                                        max_bytes=max_bytes, binary=binary)
+        listeners.append(multiprocessing.Process(target=listener_process,
+                                                 args=(queue, configurer_, latency, pipelined)))
+    for listener in listeners:
+        listener.start()
+    start_time_millis = current_milli_time()
     workers = []
     for i in range(8):
+        worker_configurer_ = configurer
+        if shards:
+            worker_configurer_ = functools.partial(configurer, worker=i)
         worker = multiprocessing.Process(target=worker_process,
-                                         args=(1 + i, queue, worker_configurer))
+                                         args=(1 + i, queue, worker_configurer_))
         workers.append(worker)
         worker.start()
     for w in workers:
         w.join()
-    queue.put_nowait(None)
-    listener.join()
+    if listeners:
+        for shard_queue in queues:
+            shard_queue.put(None)
+        for listener in listeners:
+            listener.join()
+    if shards and merge:
+        merge_start_millis = current_milli_time()
+        merge_shards([shard_path('output.txt', i) for i in range(shards)], 'output.txt')
+        print(f'Merged {shards} shards into output.txt in {current_milli_time() - merge_start_millis:_} ms', flush=True)
+    if segments is not None:
+        segments.close()
+        total_ms = current_milli_time() - start_time_millis
+        paths = segment_paths(segments.base)
+        total_lines = sum(os.path.getsize(path) for path in paths) // (len(big_line) + 1)
+        print(f'{os.path.basename(__file__)}: total lines: {total_lines:_}, total ms: {total_ms:_}, '
+              f'lines/ms: {total_lines / total_ms:.2f}, segments: {len(paths)}', flush=True)
+        if latency is not None:
+            print(latency.snapshot().format('enqueue-to-write latency'), flush=True)
+    if counters is not None:
+        print(f'Overflow policy {policy}: dropped records: {counters.dropped.value:_}, '
+              f'blocked ms: {counters.blocked_ns.value // 1_000_000:_}', flush=True)
 
 # race_cookbook_1.py: total lines: 310_793, total ms: 11_118, lines/ms: 27.95
 # + many, many errors due to full queue:
@@ -1,17 +1,29 @@
 #!/usr/bin/env python3
 
+import asyncio
 import pickle
 import logging
 import logging.handlers
+import socket
 import socketserver
 import struct
 import multiprocessing as mp
 from concurrent.futures import ProcessPoolExecutor
 import time
 import os
+import sys
+import threading
+
+import compression
+from batching import AgeFlusher
+from latency import SharedLatencyHistogram
 
 big_line = '*' * 10_000
 
+# The top two bits of a frame's length word carry the compression codec id.
+FRAME_CODEC_SHIFT = 30
+FRAME_LENGTH_MASK = (1 << FRAME_CODEC_SHIFT) - 1
+
 
 def current_milli_time():
     return time.time_ns() // 1_000_000
@@ -34,13 +46,15 @@ class LogRecordStreamHandler(socketserver.StreamRequestHandler):
             chunk = self.connection.recv(4)
             if len(chunk) < 4:
                 break
-            slen = struct.unpack('>L', chunk)[0]
+            word = struct.unpack('>L', chunk)[0]
+            codec, slen = word >> FRAME_CODEC_SHIFT, word & FRAME_LENGTH_MASK
             chunk = self.connection.recv(slen)
             while len(chunk) < slen:
                 chunk = chunk + self.connection.recv(slen - len(chunk))
-            obj = self.unPickle(chunk)
-            record = logging.makeLogRecord(obj)
-            self.handleLogRecord(record)
+            self.server.count_bytes(4 + slen)
+            obj = self.unPickle(compression.decompress(codec, chunk))
+            for d in records_from_frame(obj):
+                self.handleLogRecord(logging.makeLogRecord(d))
 
     def unPickle(self, data):
         return pickle.loads(data)
@@ -58,6 +72,8 @@ class LogRecordStreamHandler(socketserver.StreamRequestHandler):
         # to do filtering, do it at the client end to save wasting
         # cycles and network bandwidth!
         logger.handle(record)
+        if self.server.latency is not None:
+            self.server.latency.record_since(record.created)
 
 
 class LogRecordSocketReceiver(socketserver.ThreadingTCPServer):
@@ -74,6 +90,13 @@ class LogRecordSocketReceiver(socketserver.ThreadingTCPServer):
         self.abort = 0
         self.timeout = 1
         self.logname = None
+        self.bytes_received = 0
+        self.bytes_lock = threading.Lock()
+        self.latency = None
+
+    def count_bytes(self, n):
+        with self.bytes_lock:
+            self.bytes_received += n
 
     def serve_until_stopped(self, event):
         import select
@@ -86,6 +109,282 @@ class LogRecordSocketReceiver(socketserver.ThreadingTCPServer):
                 self.handle_request()
             abort = self.abort
 
+class LogRecordProtocol(asyncio.BufferedProtocol):
+    """
+    Receives 4-byte length-prefixed pickled LogRecords, the wire format of
+    logging.handlers.SocketHandler, into one reusable buffer per connection.
+
+    Every complete frame in the buffer is unpickled straight from a
+    memoryview and dispatched before returning to the event loop, so a
+    single wakeup handles as many records as one recv() delivered.
+    """
+
+    def __init__(self, receiver, buffer_size=64 * 1024):
+        self.receiver = receiver
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte of the next unparsed frame
+        self.end = 0  # end of the received bytes
+
+    def get_buffer(self, sizehint):
+        if self.end == len(self.buffer):
+            self._make_room(len(self.buffer) // 2)
+        return self.view[self.end:]
+
+    def _make_room(self, needed):
+        """
+        Make at least needed bytes of free space after self.end, moving the
+        unparsed bytes to the front and growing the buffer if that is not
+        enough.
+        """
+        pending = self.end - self.start
+        if pending + needed > len(self.buffer):
+            self._reallocate(max(2 * len(self.buffer), pending + needed))
+        elif self.start:
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+
+    def _shrink(self):
+        """
+        Drop back to buffer_size once the frame that grew the buffer has been
+        consumed, unless the partly received next frame needs the room too.
+        """
+        pending = self.end - self.start
+        needed = pending
+        if pending >= 4:
+            word = struct.unpack_from('>L', self.view, self.start)[0]
+            needed = 4 + (word & FRAME_LENGTH_MASK)
+        if needed <= self.buffer_size:
+            self._reallocate(self.buffer_size)
+
+    def _reallocate(self, size):
+        pending = self.end - self.start
+        self.view.release()
+        buffer = bytearray(size)
+        buffer[:pending] = self.buffer[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = pending
+
+    def buffer_updated(self, nbytes):
+        self.receiver.last_activity = time.monotonic()
+        self.end += nbytes
+        view = self.view
+        start = self.start
+        end = self.end
+        while end - start >= 4:
+            word = struct.unpack_from('>L', view, start)[0]
+            codec, slen = word >> FRAME_CODEC_SHIFT, word & FRAME_LENGTH_MASK
+            if end - start - 4 < slen:
+                if start + 4 + slen > len(self.buffer):
+                    self.start = start
+                    self._make_room(4 + slen - (end - start))
+                    return
+                break
+            obj = pickle.loads(compression.decompress(codec, view[start + 4:start + 4 + slen]))
+            self.receiver.bytes_received += 4 + slen
+            start += 4 + slen
+            for d in records_from_frame(obj):
+                self.receiver.handleLogRecord(logging.makeLogRecord(d))
+        if start == end:
+            start = end = 0
+        self.start = start
+        self.end = end
+        if len(self.buffer) > self.buffer_size:
+            self._shrink()
+
+
+class AsyncLogRecordReceiver:
+    """
+    asyncio-based TCP logging receiver, wire-compatible with SocketHandler.
+
+    All connections are served by one event loop on one thread. The listening
+    socket is bound on construction, like LogRecordSocketReceiver, so
+    producers can connect as soon as they start. Once stopped, it keeps
+    reading until the connections have been quiet for drain_s seconds so
+    records still in flight are not lost.
+    """
+
+    drain_s = 0.5
+
+    def __init__(self, host='localhost',
+                 port=logging.handlers.DEFAULT_TCP_LOGGING_PORT):
+        self.socket = socket.create_server((host, port), backlog=1024)
+        self.logname = None
+        self.last_activity = 0.0
+        self.bytes_received = 0
+        self.latency = None
+
+    def handleLogRecord(self, record):
+        if self.logname is not None:
+            name = self.logname
+        else:
+            name = record.name
+        logger = logging.getLogger(name)
+        logger.handle(record)
+        if self.latency is not None:
+            self.latency.record_since(record.created)
+
+    async def serve(self, event):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: LogRecordProtocol(self), sock=self.socket)
+        async with server:
+            while not event.is_set():
+                await asyncio.sleep(0.1)
+            # The producers' last frames can still be unread in the socket
+            # buffers when the stop event is set, hundreds of records each
+            # when batched; read on until the connections go quiet.
+            while time.monotonic() - self.last_activity < self.drain_s:
+                await asyncio.sleep(0.1)
+
+    def serve_until_stopped(self, event):
+        asyncio.run(self.serve(event))
+
+class BatchingSocketHandler(logging.handlers.SocketHandler):
+    """
+    A SocketHandler that packs many records into one frame.
+
+    A frame is the usual 4-byte length followed by a pickled list of record
+    dicts instead of a single dict. It is sent when the batch holds
+    batch_records records, batch_bytes bytes of messages, or when its oldest
+    record is max_latency_ms old; a batching.AgeFlusher thread enforces the
+    deadline when no further records arrive.
+
+    If codec is set to a codec id from the compression module, batches
+    of at least compression.MIN_SIZE pickled bytes are compressed and the
+    codec id goes into the top bits of the length word. Plain SocketHandler
+    frames of under 1 GiB have those bits clear. A batch that pickles to
+    1 GiB or more is sent in several frames.
+
+    A batch that cannot be sent is dropped and reported through handleError
+    with the number of records lost.
+    """
+
+    def __init__(self, host, port, batch_records=256, batch_bytes=1024 * 1024, max_latency_ms=50,
+                 codec=compression.NONE):
+        logging.handlers.SocketHandler.__init__(self, host, port)
+        self.codec = codec
+        self.batch_records = batch_records
+        self.batch_bytes = batch_bytes
+        self.max_latency = max_latency_ms / 1000
+        self._batch = []
+        self._batch_size = 0
+        self._flusher = AgeFlusher(self, self.max_latency, lambda: len(self._batch), self._send_batch,
+                                   name='log-frame-flusher')
+
+    def makeSocket(self, timeout=1):
+        # SocketHandler keeps the connect timeout for sends as well, which
+        # drops a whole batch when a multi-megabyte frame takes longer than
+        # that to drain into a busy receiver.
+        sock = logging.handlers.SocketHandler.makeSocket(self, timeout)
+        sock.settimeout(None)
+        return sock
+
+    def send(self, s):
+        """
+        Send a frame. Unlike SocketHandler.send, which drops the frame when
+        it cannot connect or the send fails, this raises OSError; the socket
+        is closed so that a later send reconnects.
+        """
+        if self.sock is None:
+            self.createSocket()
+        if self.sock is None:
+            raise ConnectionError(f'not connected to {self.host}:{self.port}')
+        try:
+            self.sock.sendall(s)
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+    def recordDict(self, record):
+        """
+        The dict makePickle would send for record.
+        """
+        ei = record.exc_info
+        if ei:
+            # just to get traceback text into record.exc_text ...
+            dummy = self.format(record)
+        d = dict(record.__dict__)
+        d['msg'] = record.getMessage()
+        d['args'] = None
+        d['exc_info'] = None
+        # Issue #25685: delete 'message' if present: redundant with 'msg'
+        d.pop('message', None)
+        return d
+
+    def emit(self, record):
+        try:
+            d = self.recordDict(record)
+            with self.lock:
+                if not self._batch:
+                    self._flusher.batch_started()
+                self._batch.append(d)
+                self._batch_size += len(d['msg'])
+                if (len(self._batch) >= self.batch_records
+                        or self._batch_size >= self.batch_bytes
+                        or self._flusher.expired()):
+                    self._send_batch()
+        except RecursionError:  # See issue 36272
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _send_batch(self):
+        """
+        Send the pending batch as one frame. Must be called with self.lock held.
+        """
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+        try:
+            self._send_frame(batch)
+        except OSError as e:
+            raise OSError(f'dropped a batch of {len(batch):_} records: {e}') from e
+
+    def _send_frame(self, batch):
+        """
+        Send batch as one frame, or split it in halves until the frames fit
+        in the FRAME_LENGTH_MASK bytes the length word can hold.
+        """
+        codec, s = compression.compress(self.codec, pickle.dumps(batch, 1))
+        if len(s) > FRAME_LENGTH_MASK:
+            if len(batch) == 1:
+                raise ValueError(f'record of {len(s):_} bytes does not fit in a frame')
+            half = len(batch) // 2
+            self._send_frame(batch[:half])
+            self._send_frame(batch[half:])
+            return
+        self.send(struct.pack('>L', codec << FRAME_CODEC_SHIFT | len(s)) + s)
+
+    def flush(self):
+        with self.lock:
+            if self._batch:
+                count = len(self._batch)
+                try:
+                    self._send_batch()
+                except Exception:
+                    self.handleError(logging.makeLogRecord(
+                        dict(msg='Sending a batch of %d records failed', args=(count,))))
+
+    def close(self):
+        self.flush()
+        logging.handlers.SocketHandler.close(self)
+
+
+def records_from_frame(obj):
+    """
+    The record dicts in an unpickled frame: a list for a batched frame from
+    BatchingSocketHandler, a single dict for a plain SocketHandler frame.
+    """
+    if isinstance(obj, list):
+        return obj
+    return (obj,)
+
+
 barrier = None
 event = None
 
@@ -104,18 +403,25 @@ def watch_workers():
     event.set()
 
 
-def send_log(thread_id):
+def send_log(thread_id, batch=False, codec=compression.NONE):
     global barrier
     rootLogger = logging.getLogger('')
     rootLogger.setLevel(logging.INFO)
-    socketHandler = logging.handlers.SocketHandler('localhost',
-                                                   logging.handlers.DEFAULT_TCP_LOGGING_PORT)
+    if batch or codec != compression.NONE:
+        socketHandler = BatchingSocketHandler('localhost',
+                                              logging.handlers.DEFAULT_TCP_LOGGING_PORT,
+                                              batch_records=256 if batch else 1,
+                                              codec=codec)
+    else:
+        socketHandler = logging.handlers.SocketHandler('localhost',
+                                                       logging.handlers.DEFAULT_TCP_LOGGING_PORT)
     # Don't bother with a formatter, since a socket handler sends the event as
     # an unformatted pickle
     rootLogger.addHandler(socketHandler)
     #logging.log(logging.INFO, 'Hello world')
     try:
         start_time_millis = current_milli_time()
+        start_cpu = time.process_time()
         spent_s = 0
         last_s = 0
         total_lines = 0
@@ -129,27 +435,38 @@ def send_log(thread_id):
             if last_s != spent_s:
                 print(f'Process {thread_id} spent {spent_s} secs', flush=True)
                 last_s = spent_s
+        socketHandler.flush()
         print(f'Process {thread_id} exiting', flush=True)
+        cpu_ms = int((time.process_time() - start_cpu) * 1000)
         barrier.wait()
-        return spent_ms, total_lines
+        return spent_ms, total_lines, cpu_ms
     except KeyboardInterrupt:
         pass
 
-def show_result(result):
+def show_result(result, wire_bytes, receiver_cpu_ms):
     total_ms = 0
     total_lines = 0
+    producer_cpu_ms = 0
     for res in result:
-        spent_ms, line_count = res
+        spent_ms, line_count, cpu_ms = res
         total_ms += spent_ms
         total_lines += line_count
+        producer_cpu_ms += cpu_ms
     lines_per_ms = total_lines / (total_ms / len(result))
     print(f'{os.path.basename(__file__)}: total lines: {total_lines:_}, total ms: {total_ms:_}, lines/ms: {lines_per_ms:.2f}', flush=True)
+    print(f'wire bytes: {wire_bytes:_}, bytes/line: {wire_bytes / total_lines:.1f}, '
+          f'producer cpu ms: {producer_cpu_ms:_}, receiver cpu ms: {receiver_cpu_ms:_}', flush=True)
 
 
 def main():
     mp.set_start_method('forkserver')
     logging.basicConfig(format='%(message)s')
-    tcpserver = LogRecordSocketReceiver()
+    if '--asyncio' in sys.argv:
+        tcpserver = AsyncLogRecordReceiver()
+    else:
+        tcpserver = LogRecordSocketReceiver()
+    if '--latency' in sys.argv:
+        tcpserver.latency = SharedLatencyHistogram()
     print('Starting TCP server...', flush=True)
     mp_context = mp.get_context('forkserver')
     try:
@@ -162,21 +479,26 @@ def main():
                                  initializer=init_worker) as pool:
             futures = []
             for x in range(max_workers):
-                fut = pool.submit(send_log, x + 1)
+                fut = pool.submit(send_log, x + 1, '--batch' in sys.argv,
+                                  compression.codec_from_argv(sys.argv))
                 futures.append(fut)
             watcher = pool.submit(watch_workers)
+            start_cpu = time.process_time()
             try:
                 tcpserver.serve_until_stopped(event)
             finally:
                 print('TCP Server exited', flush=True)
+            receiver_cpu_ms = int((time.process_time() - start_cpu) * 1000)
             watcher.result()
             res = []
             for worker in futures:
                 res.append(worker.result())
             try:
-                show_result(res)
+                show_result(res, tcpserver.bytes_received, receiver_cpu_ms)
             except Exception as e:
                 print('show_result failed: ' + str(e), flush=True)
+            if tcpserver.latency is not None:
+                print(tcpserver.latency.snapshot().format('enqueue-to-write latency'), flush=True)
     finally:
         print('Process pool exited', flush=True)
         pass
@@ -3,17 +3,47 @@ from concurrent.futures import ProcessPoolExecutor
 import logging
 import time
 import multiprocessing as mp
+from multiprocessing import shared_memory
+import pickle
+import re
+import struct
 import sys
 import os
+import weakref
+
+import compression
+from batching import AgeFlusher, flush_at_exit
+from dedup import DedupMixin
+from double_buffer import DoubleBufferedWriter, drain, write_all
+from latency import SharedLatencyHistogram
 
 big_line = '*' * 10_000
 
+# Record creation time prefixed to stamped queue messages. Big endian, so
+# that a stamped message starts with the exponent byte, never BATCH_TAG.
+STAMP = struct.Struct('>d')
+
+# Compressed queue messages: BATCH_TAG, the codec id, then the payload, a
+# batch of lines, each a BATCH_LINE header (creation time, length) and the
+# text. UTF-8 text never starts with BATCH_TAG, so readers tell these
+# messages from plain, stamped and deferred ones by their first byte.
+BATCH_TAG = b'\xff'
+BATCH_LINE = struct.Struct('<dI')
+
+# Deferred queue messages: kind, producer pid, template id, level, creation
+# time, then the template text, the pickled args or the formatted text.
+DEFERRED = struct.Struct('<BIIHd')
+TEMPLATE = 1
+RECORD = 2
+TEXT = 3
+
 def current_milli_time():
     return time.time_ns() // 1_000_000
 
 def single_producer(producer_id):
     try:
         start_time_millis = current_milli_time()
+        start_cpu = time.process_time()
         spent_s = 0
         last_s = 0
         total_lines = 0
@@ -27,62 +57,139 @@ def single_producer(producer_id):
             if last_s != spent_s:
                 print(f'Producer {producer_id} spent {spent_s} secs', flush=True)
                 last_s = spent_s
-        return spent_ms, total_lines
+        cpu_ms = int((time.process_time() - start_cpu) * 1000)
+        return spent_ms, total_lines, cpu_ms
     except KeyboardInterrupt:
         pass
     except BrokenPipeError:
         pass
 
-def init_logger(log_queue):
-    handler = MultiProcessingQueueHandler(log_queue)
+def init_logger(log_queue, codec, stamp, deferred, dedup=False):
+    handler = MultiProcessingQueueHandler(log_queue, codec, stamp, deferred, dedup=dedup)
     logging.basicConfig(level=logging.INFO, format="%(message)s", force=True, handlers=[handler])
 
 log_q = None
+log_latency = None
+log_deferred = None
+log_pipelined = False
 
-def init_reader(log_queue):
+def init_reader(log_queue, latency, deferred, pipelined=False):
     global log_q
+    global log_latency
+    global log_deferred
+    global log_pipelined
     log_q = log_queue
+    log_latency = latency
+    log_deferred = DeferredFormatter() if deferred else None
+    log_pipelined = pipelined
 
 def run_reader():
     global log_q
     assert log_q is not None
     total_lines = 0
+    wire_bytes = 0
     start_time_millis = current_milli_time()
-    while True:
-        line = log_q.get()
-        if line == '__DONE__':
-            break
-        total_lines += 1
-        print(line, file=sys.stderr, flush=True)
+    start_cpu = time.process_time()
+    # When pipelined, the reader takes every message that is ready at once
+    # and hands the lines to a writer thread, which writes them out in large
+    # chunks while the reader goes back to the queue.
+    sink = DoubleBufferedWriter(sys.stderr.fileno()) if log_pipelined else None
+    # A BytesQueue message that needs no decoding is read into a reused
+    # buffer and written from there to the file descriptor.
+    raw = isinstance(log_q, BytesQueue) and sink is None and log_deferred is None
+    done = False
+    while not done:
+        out = []
+        if sink is not None:
+            batch = drain(log_q)
+        else:
+            batch = [log_q.get_view() if raw else log_q.get()]
+        for message in batch:
+            if message == '__DONE__' or message == b'__DONE__':
+                done = True
+                break
+            wire_bytes += len(message)
+            if message[:1] == BATCH_TAG:
+                lines = batch_lines(message)
+            elif log_deferred is not None:
+                line, created = log_deferred.format(message)
+                if line is None:
+                    continue
+                lines = [(line, created)]
+            elif log_latency is not None:
+                lines = [(message[STAMP.size:], STAMP.unpack_from(message)[0])]
+            else:
+                lines = [(message, None)]
+            for line, created in lines:
+                total_lines += 1
+                if sink is not None:
+                    out.append(line + b'\n' if isinstance(line, bytes) else (line + '\n').encode())
+                elif raw:
+                    write_all(sys.stderr.fileno(), [line, b'\n'])
+                elif isinstance(line, bytes):
+                    sys.stderr.buffer.write(line + b'\n')
+                    sys.stderr.buffer.flush()
+                else:
+                    print(line, file=sys.stderr, flush=True)
+                if log_latency is not None:
+                    log_latency.record_since(created)
+        if out:
+            sink.writelines(out)
+    if sink is not None:
+        sink.close()
+        print(f'writer: writes: {sink.writes:_}, bytes/write: {sink.bytes_written / max(sink.writes, 1):_.0f}', flush=True)
     total_ms = current_milli_time() - start_time_millis
     lines_per_ms = total_lines / total_ms
     print(f'{os.path.basename(__file__)}: total lines: {total_lines:_}, total ms: {total_ms:_}, lines/ms: {lines_per_ms:.2f}', flush=True)
+    cpu_ms = int((time.process_time() - start_cpu) * 1000)
+    print(f'wire bytes: {wire_bytes:_}, bytes/line: {wire_bytes / max(total_lines, 1):.1f}, reader cpu ms: {cpu_ms:_}', flush=True)
+    if log_latency is not None:
+        label = 'enqueue-to-writer-thread latency' if log_pipelined else 'enqueue-to-write latency'
+        print(log_latency.snapshot().format(label), flush=True)
 
-def run_producer(log_queue):
+def batch_lines(message):
+    """
+    The (line, created) pairs of a compressed batch message.
+    """
+    data = bytes(compression.decompress(message[1], message[2:]))
+    lines = []
+    pos = 0
+    while pos < len(data):
+        created, size = BATCH_LINE.unpack_from(data, pos)
+        pos += BATCH_LINE.size
+        lines.append((data[pos:pos + size], created))
+        pos += size
+    return lines
+
+def run_producer(log_queue, codec=compression.NONE, latency=None, deferred=False, pipelined=False,
+                 dedup=False):
     mp_context = mp.get_context("forkserver")
     futures = []
     max_workers = 8
     try:
         with ProcessPoolExecutor(1,
                                  initializer=init_reader,
-                                 initargs=(log_queue,),
+                                 initargs=(log_queue, latency, deferred, pipelined),
                                  mp_context=mp_context) as log_consumer:
             reader_fut = log_consumer.submit(run_reader)
             with ProcessPoolExecutor(max_workers,
                                      initializer=init_logger,
-                                     initargs=(log_queue,),
+                                     initargs=(log_queue, codec, latency is not None, deferred, dedup),
                                      mp_context=mp_context) as executor:
                 for i in range(max_workers):
                     fut = executor.submit(single_producer, i + 1)
                     futures.append(fut)
                     total_ms = 0
                 total_lines = 0
+                producer_cpu_ms = 0
                 for fut in futures:
-                    spent_ms, line_count = fut.result()
+                    spent_ms, line_count, cpu_ms = fut.result()
                     total_ms += spent_ms
                     total_lines += line_count
+                    producer_cpu_ms += cpu_ms
                 lines_per_ms = total_lines / (total_ms / max_workers)
                 # print(f'{os.path.basename(__file__)}: total lines: {total_lines:_}, total ms: {total_ms:_}, lines/ms: {lines_per_ms:.2f}', flush=True)
+                print(f'producer cpu ms: {producer_cpu_ms:_}', flush=True)
             log_queue.put('__DONE__')
             reader_fut.result()
     except KeyboardInterrupt:
@@ -92,22 +199,70 @@ def run_producer(log_queue):
 
 from types import GenericAlias
 
-class MultiProcessingQueueHandler(logging.Handler):
-    def __init__(self, log_queue):
+class MultiProcessingQueueHandler(DedupMixin, logging.Handler):
+    def __init__(self, log_queue, codec=compression.NONE, stamp=False, deferred=False,
+                 max_templates=1024, dedup=False, dedup_max_delay_ms=1000,
+                 batch_bytes=1024 * 1024, batch_max_age_ms=50):
         """
         Initialize the handler.
 
         If stream is not specified, sys.stderr is used.
+
+        If codec is a codec id from the compression module, records are
+        collected into batches, which are put when they hold batch_bytes
+        bytes or are batch_max_age_ms old, or on flush(). A batch of at least
+        compression.MIN_SIZE bytes is compressed as a whole and put as one
+        message starting with BATCH_TAG and the codec id, with the creation
+        time of every record in it; stamp does not apply.
+
+        If stamp is set, records are put as bytes prefixed with the record
+        creation time, packed with STAMP, so the reader can measure latency.
+
+        If deferred is set, records are not formatted here. The first time a
+        process logs a message template it puts the template on the queue
+        once; after that a record is a DEFERRED header with the template id,
+        level and creation time, followed by the pickled args, and the reader
+        formats it with a DeferredFormatter. Records with exception or stack
+        info, non-str messages, unpicklable args and templates beyond the
+        first max_templates are put formatted, as TEXT. codec and stamp do
+        not apply to deferred records, which always carry their creation
+        time.
+
+        If dedup is set, consecutive identical records of a logger are put
+        once, followed by a "Last message repeated N times" summary within
+        dedup_max_delay_ms; see dedup.py.
         """
         logging.Handler.__init__(self)
         # assert isinstance(log_queue, mp.synchronize.Queue)
         self.log_queue = log_queue
+        self.codec = codec
+        self.stamp = stamp
+        self.deferred = deferred
+        self.max_templates = max_templates
+        self._templates = {}
+        self._templates_pid = None
+        self.batch_bytes = batch_bytes
+        self._batch = []
+        self._batch_size = 0
+        self._flusher = None
+        if codec != compression.NONE and not deferred:
+            self._flusher = AgeFlusher(self, batch_max_age_ms / 1000, lambda: len(self._batch),
+                                       self._put_batch)
+            _batching_handlers.add(self)
+        if dedup:
+            self.init_dedup(dedup_max_delay_ms / 1000)
+        self._finalizer = None
+        if self.dedup is not None or self._flusher is not None:
+            self._finalizer = flush_at_exit(self)
 
     def flush(self):
         """
-        Flushes the stream.
+        Puts any pending repeat summaries, then any pending batch.
         """
-        pass
+        self.drain_dedup()
+        with self.lock:
+            if self._batch:
+                self._put_batch()
 
     def emit(self, record):
         """
@@ -121,23 +276,340 @@ class MultiProcessingQueueHandler(logging.Handler):
         output to the stream.
         """
         try:
+            if self.deferred:
+                self.log_queue.put(self._deferred(record))
+                return
             msg = self.format(record)
+            if self._flusher is not None:
+                self._emit_batched(record, msg.encode())
+                return
+            if self.stamp:
+                if isinstance(msg, str):
+                    msg = msg.encode()
+                msg = STAMP.pack(record.created) + msg
             self.log_queue.put(msg)
         except RecursionError:  # See issue 36272
             raise
         except Exception:
             self.handleError(record)
 
+    def _emit_batched(self, record, data):
+        with self.lock:
+            if not self._batch:
+                self._flusher.batch_started()
+            self._batch.append(BATCH_LINE.pack(record.created, len(data)) + data)
+            self._batch_size += BATCH_LINE.size + len(data)
+            if self._batch_size >= self.batch_bytes or self._flusher.expired():
+                self._put_batch()
+
+    def _put_batch(self):
+        """
+        Put the pending batch as one message. Must be called with self.lock
+        held.
+        """
+        data = b''.join(self._batch)
+        self._batch = []
+        self._batch_size = 0
+        codec, payload = compression.compress(self.codec, data)
+        self.log_queue.put(BATCH_TAG + bytes((codec,)) + payload)
+
+    def _deferred(self, record):
+        pid = os.getpid()
+        if self._templates_pid != pid:
+            # The reader knows templates per process, so a forked child
+            # registers its own.
+            self._templates_pid = pid
+            self._templates = {}
+        msg = record.msg
+        template_id = None
+        if not (record.exc_info or record.stack_info) and isinstance(msg, str):
+            template_id = self._templates.get(msg)
+            if template_id is None and len(self._templates) < self.max_templates:
+                template_id = self._templates[msg] = len(self._templates)
+                self.log_queue.put(DEFERRED.pack(TEMPLATE, pid, template_id, 0, record.created) + msg.encode())
+        if template_id is not None:
+            try:
+                args = pickle.dumps(record.args, pickle.HIGHEST_PROTOCOL) if record.args else b''
+                return DEFERRED.pack(RECORD, pid, template_id, record.levelno, record.created) + args
+            except Exception:
+                pass
+        return DEFERRED.pack(TEXT, pid, 0, record.levelno, record.created) + self.format(record).encode()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._finalizer is not None:
+                self._finalizer.cancel()
+            logging.Handler.close(self)
+
     def __repr__(self):
         return "MPQueueHandler"
 
     __class_getitem__ = classmethod(GenericAlias)
 
+_batching_handlers = weakref.WeakSet()
+
+def _drop_batches_after_fork():
+    # The parent still owns the records it batched before the fork.
+    for handler in _batching_handlers:
+        handler._batch = []
+        handler._batch_size = 0
+
+os.register_at_fork(after_in_child=_drop_batches_after_fork)
+
+class DeferredFormatter:
+    """
+    Formats the deferred records put by MultiProcessingQueueHandler, keeping
+    the templates registered by every producer process.
+
+    A deferred record only carries its message, level, creation time and
+    process id, so fmt may only use the fields in fields; anything else
+    raises ValueError.
+    """
+
+    fields = frozenset(('message', 'levelname', 'levelno', 'created', 'msecs', 'asctime', 'process'))
+
+    def __init__(self, fmt="%(message)s"):
+        unknown = set(re.findall(r'%\((\w+)\)', fmt)) - self.fields
+        if unknown:
+            raise ValueError(f'Deferred records do not carry {", ".join(sorted(unknown))}')
+        self.formatter = logging.Formatter(fmt)
+        self.templates = {}
+
+    def format(self, data):
+        """
+        Return (line, created) for a queue message; line is None for a
+        template registration.
+        """
+        kind, pid, template_id, level, created = DEFERRED.unpack_from(data)
+        payload = data[DEFERRED.size:]
+        if kind == TEMPLATE:
+            self.templates[pid, template_id] = payload.decode()
+            return None, created
+        if kind == TEXT:
+            return payload.decode(), created
+        record = logging.makeLogRecord(dict(msg=self.templates[pid, template_id],
+                                            args=pickle.loads(payload) if payload else (),
+                                            levelno=level, levelname=logging.getLevelName(level),
+                                            created=created, msecs=(created - int(created)) * 1000,
+                                            process=pid))
+        return self.formatter.format(record), created
+
+class SharedMemoryRingBuffer:
+    """
+    A multi-producer, single-consumer byte ring buffer in shared memory.
+
+    It is a drop-in replacement for the SimpleQueue passed to
+    MultiProcessingQueueHandler: put() takes a str or bytes and get()
+    returns bytes. Records are stored as a 4-byte length followed by the
+    payload and may wrap around the end of the buffer, so no pickling and
+    no per-record pipe write is needed.
+
+    Producers serialize on a lock while copying their record in and block
+    while the buffer is full. The consumer reads without the lock and only
+    takes it once per drained batch to publish its read position and pick
+    up the new write position.
+    """
+
+    _header = struct.Struct('<QQQQ')  # head, tail, producers waiting, consumer waiting
+    _producers_waiting = 16
+    _length = struct.Struct('<L')
+
+    def __init__(self, capacity, ctx=None):
+        ctx = ctx or mp.get_context()
+        self.capacity = capacity
+        self._shm = shared_memory.SharedMemory(create=True, size=self._header.size + capacity)
+        self._header.pack_into(self._shm.buf, 0, 0, 0, 0, 0)
+        self._lock = ctx.Lock()
+        self._not_empty = ctx.Condition(self._lock)
+        self._not_full = ctx.Condition(self._lock)
+        self._attach()
+
+    def _attach(self):
+        self._data = self._shm.buf[self._header.size:]
+        self._head = 0  # consumer's view of the write position
+        self._tail = self._header.unpack_from(self._shm.buf, 0)[1]
+
+    def __getstate__(self):
+        return self._shm.name, self.capacity, self._lock, self._not_empty, self._not_full
+
+    def __setstate__(self, state):
+        name, self.capacity, self._lock, self._not_empty, self._not_full = state
+        try:
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Python < 3.13: the child registers the segment with the
+            # resource tracker it shares with the parent, which is harmless.
+            self._shm = shared_memory.SharedMemory(name)
+        self._attach()
+
+    def _copy_in(self, pos, data):
+        pos %= self.capacity
+        first = min(len(data), self.capacity - pos)
+        self._data[pos:pos + first] = data[:first]
+        if first < len(data):
+            self._data[:len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, size):
+        pos %= self.capacity
+        first = min(size, self.capacity - pos)
+        if first == size:
+            return bytes(self._data[pos:pos + size])
+        return bytes(self._data[pos:pos + first]) + bytes(self._data[:size - first])
+
+    def put(self, obj):
+        data = obj.encode() if isinstance(obj, str) else obj
+        need = self._length.size + len(data)
+        if need > self.capacity:
+            raise ValueError(f'record of {len(data):_} bytes does not fit in ring of {self.capacity:_} bytes')
+        buf = self._shm.buf
+        with self._lock:
+            head, tail, producers_waiting, consumer_waiting = self._header.unpack_from(buf, 0)
+            while head + need - tail > self.capacity:
+                self._header.pack_into(buf, 0, head, tail, 1, consumer_waiting)
+                self._not_full.wait(0.1)
+                head, tail, producers_waiting, consumer_waiting = self._header.unpack_from(buf, 0)
+            self._copy_in(head, self._length.pack(len(data)))
+            self._copy_in(head + self._length.size, data)
+            self._header.pack_into(buf, 0, head + need, tail, producers_waiting, consumer_waiting)
+            if consumer_waiting:
+                self._not_empty.notify()
+
+    def _sync(self, wait):
+        """
+        Publish the read position, fetch the write position and, if wait is
+        set, block until there is something to read.
+        """
+        buf = self._shm.buf
+        with self._lock:
+            head, _, waiting, _ = self._header.unpack_from(buf, 0)
+            while wait and head == self._tail:
+                self._header.pack_into(buf, 0, head, self._tail, waiting, 1)
+                self._not_empty.wait(0.1)
+                head, _, waiting, _ = self._header.unpack_from(buf, 0)
+            self._header.pack_into(buf, 0, head, self._tail, 0, 0)
+            if waiting:
+                self._not_full.notify_all()
+        self._head = head
+
+    def get(self):
+        if self._head == self._tail:
+            self._sync(wait=True)
+        size, = self._length.unpack(self._copy_out(self._tail, self._length.size))
+        data = self._copy_out(self._tail + self._length.size, size)
+        self._tail += self._length.size + size
+        if self._shm.buf[self._producers_waiting]:
+            self._sync(wait=False)
+        return data
+
+    def empty(self):
+        if self._head == self._tail:
+            self._sync(wait=False)
+        return self._head == self._tail
+
+    def close(self):
+        self._data.release()
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+class BytesQueue:
+    """
+    A SimpleQueue for bytes that skips pickling.
+
+    put() takes a str, which it encodes once, or bytes, and sends them with
+    Connection.send_bytes. get() returns bytes, as SimpleQueue would.
+    get_view() reads the next message straight from the pipe into a buffer
+    it reuses, and returns a memoryview of it that stays valid until the
+    next get_view(). Connection.recv_bytes_into would not spare a copy, as
+    it reads into an io.BytesIO first, so get_view() parses the Connection
+    framing itself: a big-endian 4-byte length, or -1 and an 8-byte length.
+    """
+
+    _size = struct.Struct('!i')
+    _large_size = struct.Struct('!Q')
+
+    def __init__(self, ctx=None, buffer_size=64 * 1024):
+        ctx = ctx or mp.get_context()
+        self._reader, self._writer = mp.Pipe(duplex=False)
+        self._rlock = ctx.Lock()
+        self._wlock = ctx.Lock()
+        self._buffer_size = buffer_size
+        self._buffer = None
+
+    def __getstate__(self):
+        return self._reader, self._writer, self._rlock, self._wlock, self._buffer_size
+
+    def __setstate__(self, state):
+        self._reader, self._writer, self._rlock, self._wlock, self._buffer_size = state
+        self._buffer = None
+
+    def put(self, obj):
+        if isinstance(obj, str):
+            obj = obj.encode()
+        with self._wlock:
+            self._writer.send_bytes(obj)
+
+    def get(self):
+        with self._rlock:
+            return self._reader.recv_bytes()
+
+    def _read_into(self, view):
+        fd = self._reader.fileno()
+        while view:
+            n = os.readv(fd, [view])
+            if n == 0:
+                raise EOFError
+            view = view[n:]
+
+    def get_view(self):
+        if self._buffer is None:
+            self._buffer = bytearray(self._buffer_size)
+        with self._rlock:
+            view = memoryview(self._buffer)
+            self._read_into(view[:self._size.size])
+            size, = self._size.unpack_from(view)
+            if size == -1:
+                self._read_into(view[:self._large_size.size])
+                size, = self._large_size.unpack_from(view)
+            if size > len(self._buffer):
+                self._buffer = bytearray(size)
+                view = memoryview(self._buffer)
+            self._read_into(view[:size])
+        return view[:size]
+
+    def empty(self):
+        return not self._reader.poll()
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
 def run_main():
     mp.set_start_method('forkserver')
     # q = mp.Manager().Queue(-1)
-    q = mp.get_context('forkserver').SimpleQueue()
-    run_producer(q)
+    codec = compression.codec_from_argv(sys.argv)
+    latency = SharedLatencyHistogram() if '--latency' in sys.argv else None
+    deferred = '--deferred' in sys.argv
+    pipelined = '--pipeline' in sys.argv
+    dedup = '--dedup' in sys.argv
+    if '--ring' in sys.argv:
+        q = SharedMemoryRingBuffer(16 * 1024 * 1024, mp.get_context('forkserver'))
+        try:
+            run_producer(q, codec, latency, deferred, pipelined, dedup)
+        finally:
+            q.close()
+            q.unlink()
+    elif '--bytes' in sys.argv:
+        q = BytesQueue(mp.get_context('forkserver'))
+        run_producer(q, codec, latency, deferred, pipelined, dedup)
+    else:
+        q = mp.get_context('forkserver').SimpleQueue()
+        run_producer(q, codec, latency, deferred, pipelined, dedup)
 
 if __name__ == "__main__":
     run_main()
@@ -6,7 +6,11 @@ import multiprocessing as mp
 import sys
 import os
 
-big_line = '*' * 10_000
+from latency import SharedLatencyHistogram
+from locks import InstrumentedLock, TicketLock
+from mp_handler import MultiProcessingStreamHandler, handler_kwargs_from_argv
+
+big_line = '*' * int(os.environ.get('LINE_LENGTH', 10_000))
 
 def current_milli_time():
     return time.time_ns() // 1_000_000
@@ -54,92 +58,21 @@ def run_producer():
     except BrokenPipeError:
         pass
 
-from types import GenericAlias
-
-class MultiProcessingStreamHandler(logging.Handler):
-    """
-    A handler class which writes logging records, appropriately formatted,
-    to a stream. Note that this class does not close the stream, as
-    sys.stdout or sys.stderr may be used.
-    """
-
-    terminator = "\n"
-
-    def __init__(self, multiprocess_lock, stream=sys.stderr):
-        """
-        Initialize the handler.
-
-        If stream is not specified, sys.stderr is used.
-        """
-        logging.Handler.__init__(self)
-        assert isinstance(multiprocess_lock, mp.synchronize.RLock)
-        self.multiprocess_lock = multiprocess_lock
-        self.stream = stream
-
-    def flush(self):
-        """
-        Flushes the stream.
-        """
-        with self.lock:
-            if self.stream and hasattr(self.stream, "flush"):
-                self.stream.flush()
-
-    def emit(self, record):
-        """
-        Emit a record.
-
-        If a formatter is specified, it is used to format the record.
-        The record is then written to the stream with a trailing newline.  If
-        exception information is present, it is formatted using
-        traceback.print_exception and appended to the stream.  If the stream
-        has an 'encoding' attribute, it is used to determine how to do the
-        output to the stream.
-        """
-        try:
-            with self.multiprocess_lock:
-                msg = self.format(record)
-                stream = self.stream
-                # issue 35046: merged two stream.writes into one.
-                stream.write(msg + self.terminator)
-                self.flush()
-        except RecursionError:  # See issue 36272
-            raise
-        except Exception:
-            self.handleError(record)
-
-    def setStream(self, stream):
-        """
-        Sets the StreamHandler's stream to the specified value,
-        if it is different.
-
-        Returns the old stream, if the stream was changed, or None
-        if it wasn't.
-        """
-        if stream is self.stream:
-            result = None
-        else:
-            result = self.stream
-            with self.lock:
-                self.flush()
-                self.stream = stream
-        return result
-
-    def __repr__(self):
-        level = getLevelName(self.level)
-        name = getattr(self.stream, "name", "")
-        #  bpo-36015: name can be an int
-        name = str(name)
-        if name:
-            name += " "
-        return "<%s %s(%s)>" % (self.__class__.__name__, name, level)
-
-    __class_getitem__ = classmethod(GenericAlias)
-
 def run_main():
     mp.set_start_method('forkserver')
-    handler = MultiProcessingStreamHandler(mp.get_context('forkserver').RLock())
+    latency = SharedLatencyHistogram() if '--latency' in sys.argv else None
+    ctx = mp.get_context('forkserver')
+    lock = TicketLock(ctx) if '--ticket' in sys.argv else ctx.RLock()
+    if '--lockstats' in sys.argv:
+        lock = InstrumentedLock(lock)
+    handler = MultiProcessingStreamHandler(lock, latency=latency, **handler_kwargs_from_argv(sys.argv))
     logging.basicConfig(level=logging.INFO, format="%(message)s", force=True, handlers=[handler])
     run_producer()
+    handler.flush()
+    if latency is not None:
+        print(latency.snapshot().format('enqueue-to-write latency'), flush=True)
+    if isinstance(lock, InstrumentedLock):
+        print(lock.format(), flush=True)
 
 if __name__ == "__main__":
     run_main()
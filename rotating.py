@@ -0,0 +1,128 @@
+"""
+A size-rotating file handler for the queue listener.
+
+RotatingFileHandler.shouldRollover runs for every record: it checks that the
+file is a regular file with two stat calls, formats the record a second time
+to learn its length, and seeks to the end to ask the stream for its size.
+SizeRotatingFileHandler instead counts what it writes, so the check is one
+addition and one comparison, and every record is formatted once.
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import stat
+import sys
+import threading
+import traceback
+
+
+class SizeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A drop-in RotatingFileHandler that keeps the size of the current file in
+    memory.
+
+    The size is taken from the file when it is opened and then grows by the
+    length of every formatted record, counted in characters as the stock
+    handler does. Nothing else may write to the file meanwhile.
+
+    With background set, a rollover only renames the current file to a
+    temporary name next to it and opens a new one. A rotation thread closes
+    the old stream and shifts the backups, in the order the rollovers
+    happened, while records go on to the new file. That keeps closing a
+    large file, deleting the oldest backup and a custom rotator off the
+    intake path. close() waits for pending rotations.
+    """
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0, encoding=None, delay=False,
+                 errors=None, background=False):
+        self._size = 0
+        self._regular = True
+        self.background = background and backupCount > 0
+        self._rollovers = 0
+        self._rotations = queue.SimpleQueue()
+        self._rotation_thread = None
+        logging.handlers.RotatingFileHandler.__init__(self, filename, mode, maxBytes, backupCount,
+                                                      encoding, delay, errors)
+
+    def _open(self):
+        stream = logging.handlers.RotatingFileHandler._open(self)
+        st = os.fstat(stream.fileno())
+        self._size = st.st_size
+        self._regular = stat.S_ISREG(st.st_mode)
+        return stream
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        return (self.maxBytes > 0 and self._regular
+                and self._size + len(self.format(record)) + len(self.terminator) >= self.maxBytes)
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self._regular and self._size + len(msg) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(msg)
+            self.flush()
+            self._size += len(msg)
+        except RecursionError:  # See issue 36272
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def doRollover(self):
+        if not self.background:
+            logging.handlers.RotatingFileHandler.doRollover(self)
+            return
+        pending = f'{self.baseFilename}.rotating{self._rollovers}'
+        self._rollovers += 1
+        os.rename(self.baseFilename, pending)
+        old, self.stream = self.stream, None
+        if self._rotation_thread is None:
+            self._rotation_thread = threading.Thread(target=self._rotate, name='SizeRotatingFileHandler',
+                                                     daemon=True)
+            self._rotation_thread.start()
+        self._rotations.put((old, pending))
+        self._size = 0
+        if not self.delay:
+            self.stream = self._open()
+
+    def _shift(self, pending):
+        # RotatingFileHandler.doRollover, starting from the renamed file.
+        for i in range(self.backupCount - 1, 0, -1):
+            sfn = self.rotation_filename(f'{self.baseFilename}.{i}')
+            dfn = self.rotation_filename(f'{self.baseFilename}.{i + 1}')
+            if os.path.exists(sfn):
+                if os.path.exists(dfn):
+                    os.remove(dfn)
+                os.rename(sfn, dfn)
+        dfn = self.rotation_filename(self.baseFilename + '.1')
+        if os.path.exists(dfn):
+            os.remove(dfn)
+        self.rotate(pending, dfn)
+
+    def _rotate(self):
+        while True:
+            item = self._rotations.get()
+            if item is None:
+                return
+            old, pending = item
+            try:
+                if old is not None:
+                    old.close()
+                self._shift(pending)
+            except Exception:
+                print(f'Rotating {pending} failed:', file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+
+    def close(self):
+        logging.handlers.RotatingFileHandler.close(self)
+        if self._rotation_thread is not None:
+            self._rotations.put(None)
+            self._rotation_thread.join()
+            self._rotation_thread = None
@@ -1,18 +1,12 @@
 #!/usr/bin/env bash
 
-echo '' > results.txt
+set -euo pipefail
 
-./race_threads_original.py 2> ./output.txt | tee -a results.txt
-./race_threads_mp_rlock.py 2> ./output.txt | tee -a results.txt
+# The original comparison: 8 threads, 10,000 character lines, 60 s runs,
+# unlocked StreamHandler vs MultiProcessingStreamHandler. Pass extra
+# bench.py arguments to change or extend the sweep, e.g.
+# ./runperf.sh --transport unlocked mp_rlock simple_queue socket --mode thread process
 
-./race_threads_original.py 2> ./output.txt | tee -a results.txt
-./race_threads_mp_rlock.py 2> ./output.txt | tee -a results.txt
-
-./race_threads_original.py 2> ./output.txt | tee -a results.txt
-./race_threads_mp_rlock.py 2> ./output.txt | tee -a results.txt
-
-./race_threads_original.py 2> ./output.txt | tee -a results.txt
-./race_threads_mp_rlock.py 2> ./output.txt | tee -a results.txt
-
-./race_threads_original.py 2> ./output.txt | tee -a results.txt
-./race_threads_mp_rlock.py 2> ./output.txt | tee -a results.txt
+./bench.py --transport unlocked mp_rlock --mode thread --workers 8 --line-size 10000 \
+           --duration 60 --warmup 0 --repeats 5 --output results "$@"
+./summary.py results.json
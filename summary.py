@@ -1,29 +1,32 @@
 #!/usr/bin/env python3
+import json
+import statistics
+import sys
+
+KEY = ('transport', 'mode', 'workers', 'line_size', 'start_method')
 
 def run_main():
-    org_ms = 0
-    org_lines = 0
-    mplock_ms = 0
-    mplock_lines = 0
-    with open('results.txt') as fd:
-        for lin in fd.readlines():
-            lin = lin.strip()
-            if 'total' not in lin:
-                continue
-            line_count = int(lin.split('total lines: ')[1].split(',')[0].replace('_', ''))
-            spent_ms = int(lin.split('total ms: ')[1].split(',')[0].replace('_', ''))
-            if 'original.py' in lin:
-                org_ms += spent_ms
-                org_lines += line_count
-            else:
-                mplock_ms += spent_ms
-                mplock_lines += line_count
-    org_lines_ms = org_lines / org_ms
-    mplock_lines_ms = mplock_lines / mplock_ms
-    mplock_relative = (100 * mplock_lines_ms) / org_lines_ms
-    print(f'Original total lines: {org_lines:_}, total ms: {org_ms:_}, lines/ms: { (org_lines / (org_ms / 8)):.2f}')
-    print(f'mp.Rlock total lines: {mplock_lines:_}, total ms: {mplock_ms:_}, lines/ms: { (mplock_lines / (mplock_ms / 8)):.2f}')
-    print(f'mp.Rlock performance: {mplock_relative:.2f} %')
+    path = sys.argv[1] if len(sys.argv) > 1 else 'results.json'
+    with open(path) as fd:
+        results = json.load(fd)
+    groups = {}
+    for res in results:
+        groups.setdefault(tuple(res[k] for k in KEY), []).append(res)
+    baseline = {}
+    for key, runs in groups.items():
+        if key[0] == 'unlocked':
+            baseline[key[1:]] = statistics.mean(r['lines_per_ms'] for r in runs)
+    for key, runs in groups.items():
+        transport, mode, workers, line_size, start_method = key
+        lines = sum(r['lines'] for r in runs)
+        lines_ms = statistics.mean(r['lines_per_ms'] for r in runs)
+        e2e_lines_ms = statistics.mean(r['end_to_end_lines_per_ms'] for r in runs)
+        msg = (f'{transport} {mode} workers={workers} line_size={line_size} {start_method}: '
+               f'runs: {len(runs)}, total lines: {lines:_}, lines/ms: {lines_ms:.2f}, '
+               f'end-to-end lines/ms: {e2e_lines_ms:.2f}')
+        if key[1:] in baseline:
+            msg += f', vs unlocked: {(100 * lines_ms) / baseline[key[1:]]:.2f} %'
+        print(msg)
 
 if __name__ == "__main__":
     run_main()
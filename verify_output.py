@@ -1,16 +1,104 @@
 #!/usr/bin/env python3
+import mmap
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-big_line = '*' * 10_000
+big_line = b'*' * int(os.environ.get('LINE_LENGTH', 10_000))
 
-if __name__ == "__main__":
-    with open('output.txt') as fd:
-        for lin in fd.readlines():
-            lin = lin.strip()
-            if lin != big_line:
-                print('error')
-                print(lin)
-                sys.exit(1)
-    print('output.txt OK')
+# Bytes checked per pass; bounds the memory each worker uses.
+WINDOW = 8 * 1024 * 1024
+
+def line_ranges(mm, parts):
+    """
+    Split mm into at most parts (start, end) ranges that begin and end on
+    line boundaries.
+    """
+    size = len(mm)
+    bounds = [0]
+    for i in range(1, parts):
+        nl = mm.find(b'\n', max(size * i // parts, bounds[-1]))
+        if nl == -1:
+            break
+        if nl + 1 > bounds[-1]:
+            bounds.append(nl + 1)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+def bucket(length):
+    """
+    Histogram bucket of a line length: lengths in [2**(b-1), 2**b) go to b.
+    """
+    return length.bit_length()
 
+def check_block(block, offset, result):
+    stride = len(big_line) + 1
+    line_count = block.count(b'\n')
+    if (len(block) == line_count * stride
+            and block[len(big_line)::stride].count(b'\n') == line_count
+            and not block.translate(None, b'*\n')):
+        result['lines'] += line_count
+        result['histogram'][bucket(len(big_line))] = result['histogram'].get(bucket(len(big_line)), 0) + line_count
+        return
+    pos = 0
+    for line in block.split(b'\n'):
+        if pos == len(block):
+            break
+        result['lines'] += 1
+        b = bucket(len(line))
+        result['histogram'][b] = result['histogram'].get(b, 0) + 1
+        if line.strip() != big_line:
+            result['bad'] += 1
+            if result['first_bad'] is None:
+                result['first_bad'] = offset + pos
+        pos += len(line) + 1
 
+def check_range(path, start, end):
+    """
+    Check the lines in bytes [start, end) of path, WINDOW bytes at a time.
+    """
+    result = dict(lines=0, bad=0, first_bad=None, histogram={})
+    with open(path, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        while pos < end:
+            stop = min(pos + WINDOW, end)
+            if stop < end:
+                nl = mm.find(b'\n', stop, end)
+                stop = end if nl == -1 else nl + 1
+            check_block(mm[pos:stop], pos, result)
+            pos = stop
+    return result
+
+def verify(path, workers=None):
+    if os.path.getsize(path) == 0:
+        return dict(lines=0, bad=0, first_bad=None, histogram={})
+    workers = workers or os.cpu_count()
+    with open(path, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        ranges = line_ranges(mm, workers * 4)
+    total = dict(lines=0, bad=0, first_bad=None, histogram={})
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(check_range, path, start, end) for start, end in ranges]
+        for fut in futures:
+            result = fut.result()
+            total['lines'] += result['lines']
+            total['bad'] += result['bad']
+            if total['first_bad'] is None:
+                total['first_bad'] = result['first_bad']
+            for b, count in result['histogram'].items():
+                total['histogram'][b] = total['histogram'].get(b, 0) + count
+    return total
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else 'output.txt'
+    total = verify(path)
+    print(f'Line count: {total["lines"]:_}, bad line count: {total["bad"]:_}')
+    print('Line length histogram:')
+    for b in sorted(total['histogram']):
+        low = 0 if b == 0 else 1 << (b - 1)
+        high = (1 << b) - 1
+        print(f'  {low:>10_} - {high:>10_}: {total["histogram"][b]:_}')
+    if total['bad']:
+        print('error')
+        print(f'First bad line at byte offset {total["first_bad"]:_}')
+        sys.exit(1)
+    print(f'{path} OK')